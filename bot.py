@@ -1,12 +1,33 @@
 import logging
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from datetime import datetime, time, timedelta
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, MessageHandler, filters, ContextTypes
+from datetime import date, datetime, time, timedelta
 import pytz
 import os
 import json
+import sqlite3
 import asyncio
-from typing import Dict, Any, List
+import heapq
+import bisect
+import atexit
+import queue
+import threading
+import sys
+import itertools
+import hmac
+import hashlib
+import signal
+import importlib.util
+import multiprocessing
+import functools
+import contextlib
+import marshal
+from time import perf_counter, time as unix_time
+from typing import Dict, Any, List, Callable
+from collections import OrderedDict
+from local_http import HTTPRequest, LocalHTTPServer
 
 # Настройка логирования
 logging.basicConfig(
@@ -31,14 +52,768 @@ AUTO_REPLY_MESSAGE = """Здравствуйте, вы написали в не
 # ID администраторов
 ADMIN_IDS = {7842709072, 1772492746}
 
+# Горизонтальное масштабирование: при SHARD_COUNT > 1 процесс-приемник получает обновления
+# и раздает их SHARD_COUNT процессам-обработчикам, каждый из которых владеет своей частью
+# chat_id (chat_id % SHARD_COUNT) и своими файлами непрочитанных сообщений и флагов
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+# Номер шарда; задается процессом-приемником при запуске обработчика
+SHARD_ID = int(os.environ['BOT_SHARD_ID']) if os.environ.get('BOT_SHARD_ID') else None
+IS_SHARD_INGEST = SHARD_COUNT > 1 and SHARD_ID is None
+# Как часто проверяются изменения файлов настроек, измененных извне или другим процессом (секунды)
+CONFIG_RELOAD_INTERVAL = float(os.environ.get('CONFIG_RELOAD_INTERVAL', '2'))
+# Как часто обработчики пересчитывают статусы воронок своих сообщений (секунды)
+SHARD_FUNNEL_UPDATE_INTERVAL = float(os.environ.get('SHARD_FUNNEL_UPDATE_INTERVAL', '60'))
+
+def shard_file(path: str, shard_id: int = SHARD_ID) -> str:
+    """Имя файла состояния шарда: pending_messages.json -> pending_messages.shard0.json"""
+    if shard_id is None:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{shard_id}{ext}"
+
 # Файлы для сохранения данных
-FLAGS_FILE = "auto_reply_flags.json"
+FLAGS_FILE = shard_file("auto_reply_flags.json")
 WORK_CHAT_FILE = "work_chat.json"
-PENDING_MESSAGES_FILE = "pending_messages.json"
+PENDING_MESSAGES_FILE = shard_file("pending_messages.json")
 FUNNELS_CONFIG_FILE = "funnels_config.json"
 EXCLUDED_USERS_FILE = "excluded_users.json"
-FUNNELS_STATE_FILE = "funnels_state.json"
+FUNNELS_STATE_FILE = shard_file("funnels_state.json")
 MASTER_NOTIFICATION_FILE = "master_notification.json"
+PENDING_JOURNAL_FILE = shard_file("pending_messages.journal")
+PENDING_DB_FILE = shard_file("pending_messages.db")
+STATE_SNAPSHOT_FILE = shard_file("state_snapshot.bin")
+# Число шардов, на которое разделено состояние
+SHARDS_FILE = "shards.json"
+BUSINESS_CALENDAR_FILE = "business_calendar.json"
+
+# Рабочие окна по умолчанию (понедельник-пятница), если нет business_calendar.json
+DEFAULT_BUSINESS_WINDOWS = [["10:00", "19:00"]]
+
+# Хранилище непрочитанных сообщений: "json" (снимок + журнал) или "sqlite"
+PENDING_STORAGE = os.environ.get('PENDING_STORAGE', 'json').lower()
+
+# Журнал изменений непрочитанных сообщений: каждое изменение дописывается одной строкой,
+# полный снимок PENDING_MESSAGES_FILE перезаписывается только при компактификации
+PENDING_JOURNAL_ENABLED = os.environ.get('PENDING_JOURNAL_ENABLED', '1') == '1'
+PENDING_JOURNAL_COMPACT_EVERY = int(os.environ.get('PENDING_JOURNAL_COMPACT_EVERY', '500'))
+
+# Обновлять единое уведомление редактированием вместо удаления и отправки нового
+NOTIFICATION_EDIT_MODE = os.environ.get('NOTIFICATION_EDIT_MODE', '0') == '1'
+
+# Обновление уведомления после ответов менеджеров откладывается на NOTIFICATION_REFRESH_DEBOUNCE сек.
+# после последнего ответа, но не дольше NOTIFICATION_REFRESH_MAX_DELAY сек. от первого (0 - обновлять сразу)
+NOTIFICATION_REFRESH_DEBOUNCE = float(os.environ.get('NOTIFICATION_REFRESH_DEBOUNCE', '5'))
+NOTIFICATION_REFRESH_MAX_DELAY = float(os.environ.get('NOTIFICATION_REFRESH_MAX_DELAY', '30'))
+
+# Сколько старых уведомлений удаляется одновременно
+NOTIFICATION_DELETE_CONCURRENCY = int(os.environ.get('NOTIFICATION_DELETE_CONCURRENCY', '5'))
+
+# Сколько последних апдейтов помнит кэш проверки менеджеров
+EXCLUDED_MEMO_SIZE = 256
+
+# Что хранить из текста непрочитанного сообщения (в отчетах текст не показывается):
+# "full" - весь текст, "preview" - первые MESSAGE_PREVIEW_LENGTH символов, "none" - ничего,
+# "external" - текст в отдельном файле каталога MESSAGE_BODIES_DIR (имя - хэш содержимого)
+MESSAGE_BODY_POLICY = os.environ.get('MESSAGE_BODY_POLICY', 'full').lower()
+MESSAGE_PREVIEW_LENGTH = int(os.environ.get('MESSAGE_PREVIEW_LENGTH', '100'))
+MESSAGE_BODIES_DIR = shard_file("message_bodies")
+# Как часто удаляются файлы текстов, на которые больше не ссылается ни одно сообщение (секунды)
+MESSAGE_BODIES_GC_INTERVAL = float(os.environ.get('MESSAGE_BODIES_GC_INTERVAL', '3600'))
+
+# Сколько секунд действует флаг отправленного автоответа (потом автоответ отправится снова)
+AUTO_REPLY_FLAG_TTL = float(os.environ.get('AUTO_REPLY_FLAG_TTL', str(14 * 24 * 3600)))
+# Сколько секунд хранится отметка об обработке сообщения воронкой
+FUNNEL_STATE_TTL = float(os.environ.get('FUNNEL_STATE_TTL', str(30 * 24 * 3600)))
+# Как часто из флагов и состояния воронок удаляются устаревшие записи (секунды)
+STATE_COMPACT_INTERVAL = float(os.environ.get('STATE_COMPACT_INTERVAL', '3600'))
+
+# Интервал отложенного сохранения состояния в секундах (0 - сохранять сразу при каждом изменении)
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', '5'))
+
+# Бинарный снимок состояния для быстрого запуска: пишется при остановке и раз в интервал (секунды).
+# В режиме шардов не используется: состояние процессов синхронизируется отдельно
+STATE_SNAPSHOT_ENABLED = os.environ.get('STATE_SNAPSHOT_ENABLED', '1') == '1' and SHARD_COUNT == 1
+STATE_SNAPSHOT_INTERVAL = float(os.environ.get('STATE_SNAPSHOT_INTERVAL', '600'))
+
+# Режим получения обновлений: "polling" (getUpdates) или "webhook" (встроенный HTTP-сервер)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').lower()
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', '8080')))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+# Публичный адрес вебхука; если не задан, setWebhook не вызывается (удобно для локальной проверки)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN', '')
+# Сколько обновлений обрабатывается одновременно (обработчики регистрируются блокирующими,
+# поэтому именно этот лимит ограничивает число параллельных вызовов; порядок внутри
+# одного чата сохраняется независимо от него)
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '64'))
+
+# Адрес Bot API (к нему дописываются токен и метод); для проверки без сети -
+# адрес локальной замены из fake_bot_api.py, например http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = 'https://api.telegram.org/bot'
+BOT_API_BASE_URL = os.environ.get('BOT_API_BASE_URL', TELEGRAM_API_BASE_URL)
+
+# HTTP-транспорт: отдельные пулы соединений для отправки запросов и для long polling (getUpdates).
+# По умолчанию размер пула как у ApplicationBuilder в PTB (256): параллельность отправки
+# и так ограничивает PriorityRateLimiter, а меньший пул лишь добавляет ожидание pool_timeout
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '256'))
+HTTP_POLL_POOL_SIZE = int(os.environ.get('HTTP_POLL_POOL_SIZE', '1'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '5'))
+HTTP_WRITE_TIMEOUT = float(os.environ.get('HTTP_WRITE_TIMEOUT', '5'))
+HTTP_POOL_TIMEOUT = float(os.environ.get('HTTP_POOL_TIMEOUT', '3'))
+# Версия HTTP: "1.1" или "2" (для HTTP/2 нужен пакет h2, без него используется 1.1)
+HTTP_VERSION = os.environ.get('HTTP_VERSION', '1.1')
+
+# Эндпоинт метрик в текстовом формате Prometheus (0 - выключен).
+# Процессы-обработчики шардов слушают METRICS_PORT + 1 + номер шарда
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PATH = os.environ.get('METRICS_PATH', '/metrics')
+# Сколько последних замеров хранится на каждый обработчик для /perf
+PERF_RESERVOIR_SIZE = int(os.environ.get('PERF_RESERVOIR_SIZE', '1024'))
+
+# Ограничения исходящих запросов к Bot API (лимиты Telegram: ~30 сообщений в секунду всего,
+# ~1 в секунду в личный чат, 20 в минуту в группу)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', '25'))
+OUTBOUND_PRIVATE_RATE = float(os.environ.get('OUTBOUND_PRIVATE_RATE', '1'))
+OUTBOUND_GROUP_PER_MINUTE = float(os.environ.get('OUTBOUND_GROUP_PER_MINUTE', '20'))
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '3'))
+
+# Приоритеты исходящих запросов (меньше - раньше)
+PRIORITY_AUTO_REPLY = 0
+PRIORITY_COMMAND = 1
+PRIORITY_NOTIFICATION = 2
+PRIORITY_BULK = 3
+
+# ========== МЕТРИКИ ==========
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (счетчики без накопления, накапливаются при выводе)"""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        # Граница le включительная: значение, равное границе, попадает в ее корзину
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Метрики процесса для эндпоинта METRICS_PATH.
+    
+    Значения только растут (сбрасываются перезапуском), как того ожидает Prometheus;
+    при выключенном эндпоинте ничего не записывается. Поток записи состояния добавляет
+    значения параллельно с event loop, поэтому изменения и вывод идут под self.lock.
+    """
+    
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.handler_latency: Dict[str, Histogram] = {}
+        self.api_latency: Dict[str, Histogram] = {}
+        self.api_errors: Dict[tuple, int] = {}
+        self.write_latency: Dict[str, Histogram] = {}
+        self.write_bytes: Dict[str, int] = {}
+        self.serialize_latency: Dict[str, Histogram] = {}
+    
+    def _observe(self, family: Dict[str, Histogram], name: str, seconds: float):
+        with self.lock:
+            histogram = family.get(name)
+            if histogram is None:
+                histogram = family[name] = Histogram()
+            histogram.observe(seconds)
+    
+    def observe_handler(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        self._observe(self.handler_latency, name, seconds)
+    
+    def observe_api(self, endpoint: str, seconds: float, status_code: int = None):
+        if not self.enabled:
+            return
+        self._observe(self.api_latency, endpoint, seconds)
+        if status_code is None or status_code >= 400:
+            reason = str(status_code) if status_code else 'network'
+            with self.lock:
+                self.api_errors[(endpoint, reason)] = self.api_errors.get((endpoint, reason), 0) + 1
+    
+    def observe_write(self, name: str, seconds: float, size: int = 0):
+        """Вызывается из потока записи состояния"""
+        if not self.enabled:
+            return
+        self._observe(self.write_latency, name, seconds)
+        with self.lock:
+            self.write_bytes[name] = self.write_bytes.get(name, 0) + size
+    
+    def observe_serialize(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        self._observe(self.serialize_latency, name, seconds)
+
+metrics = MetricsRegistry(METRICS_PORT > 0)
+
+def observe_latency(name: str):
+    """Декоратор корутины: время выполнения попадает в гистограмму bot_handler_duration_seconds"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return await func(*args, **kwargs)
+            started = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe_handler(name, perf_counter() - started)
+        return wrapper
+    return decorator
+
+class LatencyReservoir:
+    """Последние size замеров одного обработчика (кольцевой буфер фиксированного размера)"""
+    __slots__ = ('samples', 'size', 'position', 'calls', 'max_seconds')
+    
+    def __init__(self, size: int):
+        self.samples: List[float] = []
+        self.size = size
+        self.position = 0
+        self.calls = 0
+        self.max_seconds = 0.0
+    
+    def observe(self, seconds: float):
+        if len(self.samples) < self.size:
+            self.samples.append(seconds)
+        else:
+            self.samples[self.position] = seconds
+            self.position = (self.position + 1) % self.size
+        self.calls += 1
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+    
+    def percentiles(self, *fractions: float) -> List[float]:
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return [ordered[min(last, int(round(fraction * last)))] for fraction in fractions]
+
+class PerfStats:
+    """Время выполнения зарегистрированных обработчиков и задач для команды /perf"""
+    
+    def __init__(self, reservoir_size: int):
+        self.reservoir_size = max(1, reservoir_size)
+        self.reservoirs: Dict[str, LatencyReservoir] = {}
+    
+    def observe(self, name: str, seconds: float):
+        reservoir = self.reservoirs.get(name)
+        if reservoir is None:
+            reservoir = self.reservoirs[name] = LatencyReservoir(self.reservoir_size)
+        reservoir.observe(seconds)
+    
+    def reset(self):
+        self.reservoirs.clear()
+
+perf_stats = PerfStats(PERF_RESERVOIR_SIZE)
+
+def timed_callback(callback: Callable) -> Callable:
+    """Оборачивает обработчик или задачу: время выполнения попадает в perf_stats"""
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            perf_stats.observe(name, perf_counter() - started)
+    return wrapper
+
+def instrument_handlers(application: Application):
+    """Подключает замер времени ко всем зарегистрированным обработчикам приложения"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_callback(handler.callback)
+
+# ========== ОТЛОЖЕННОЕ СОХРАНЕНИЕ СОСТОЯНИЯ ==========
+
+def write_file_atomic(path: str, text):
+    """Записывает файл (str или bytes) через временный файл и переименование, чтобы при сбое не остался обрезанный файл"""
+    tmp_path = f"{path}.tmp"
+    data = text if isinstance(text, bytes) else text.encode('utf-8')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def state_file_label(path: str) -> str:
+    """Метка файла состояния для метрик; тексты сообщений (по файлу на хэш) - одна общая метка"""
+    if os.path.dirname(path) == MESSAGE_BODIES_DIR:
+        return 'message_body'
+    return os.path.basename(path)
+
+class StateWriter:
+    """Выполняет запись файлов состояния в отдельном потоке, чтобы не блокировать event loop.
+    
+    В очередь попадают уже сериализованные строки - неизменяемые снимки состояния,
+    поэтому поток записи не обращается к объектам, которые меняют обработчики.
+    """
+    
+    def __init__(self):
+        self.queue: "queue.Queue" = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+        self.thread.start()
+    
+    def write_json(self, path: str, data: Any, **dump_kwargs):
+        """Сериализует данные сейчас и ставит полную перезапись файла в очередь"""
+        if not metrics.enabled:
+            self.write_text(path, json.dumps(data, **dump_kwargs))
+            return
+        started = perf_counter()
+        text = json.dumps(data, **dump_kwargs)
+        metrics.observe_serialize(os.path.basename(path), perf_counter() - started)
+        self.write_text(path, text)
+    
+    def write_text(self, path: str, text: str):
+        self.queue.put(('replace', path, text))
+    
+    def append_text(self, path: str, text: str):
+        self.queue.put(('append', path, text))
+    
+    def submit(self, name: str, func: Callable[[], None]):
+        """Выполняет произвольную операцию записи (например, транзакцию SQLite) в потоке записи"""
+        self.queue.put(('call', name, func))
+    
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                op, path, text = task
+                started = perf_counter()
+                if op == 'replace':
+                    write_file_atomic(path, text)
+                elif op == 'call':
+                    text()
+                else:
+                    with open(path, 'ab') as f:
+                        f.write(text.encode('utf-8'))
+                        f.flush()
+                        os.fsync(f.fileno())
+                if metrics.enabled:
+                    size = len(text.encode('utf-8')) if op != 'call' else 0
+                    metrics.observe_write(state_file_label(path), perf_counter() - started, size)
+            except Exception as e:
+                logger.error(f"Ошибка записи файла состояния {task[1]}: {e}")
+            finally:
+                self.queue.task_done()
+    
+    def wait(self):
+        """Ожидает, пока все поставленные в очередь записи будут выполнены"""
+        self.queue.join()
+    
+    def stop(self):
+        """Дописывает очередь и останавливает поток записи"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+class StateFlusher:
+    """Объединяет изменения состояния: каждый файл записывается не чаще одного раза за интервал"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.savers: Dict[str, Callable[[], None]] = {}
+        self.dirty = set()
+    
+    def register(self, name: str, saver: Callable[[], None]):
+        """Регистрирует функцию сохранения для файла состояния"""
+        self.savers[name] = saver
+    
+    def mark_dirty(self, name: str):
+        """Помечает файл как измененный; без интервала сохраняет его сразу"""
+        if self.interval <= 0:
+            self.savers[name]()
+            return
+        self.dirty.add(name)
+    
+    def flush(self) -> int:
+        """Записывает все измененные файлы"""
+        dirty, self.dirty = self.dirty, set()
+        for name in dirty:
+            try:
+                self.savers[name]()
+            except Exception as e:
+                logger.error(f"Ошибка отложенного сохранения {name}: {e}")
+        return len(dirty)
+
+class StateSnapshot:
+    """Все файлы состояния в одном бинарном файле (marshal) для быстрого запуска.
+    
+    Раздел снимка - данные одного файла состояния и размер/mtime его файлов на момент
+    записи снимка. При запуске менеджер берет раздел через take(), только если его файлы
+    с тех пор не менялись (например, не были исправлены вручную); иначе читает свой JSON.
+    JSON-файлы остаются основным хранилищем и пишутся как прежде.
+    """
+    
+    MAGIC = b'BOTSNAP1'
+    
+    def __init__(self, path: str, enabled: bool):
+        self.path = path
+        self.enabled = enabled
+        self.sections: Dict[str, tuple] = {}
+        self.providers: Dict[str, tuple] = {}
+        # Откуда загружен каждый раздел: 'snapshot' или 'json'
+        self.sources: Dict[str, str] = {}
+        self.load_seconds = 0.0
+        if enabled:
+            self.load()
+    
+    def load(self):
+        started = perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            if not raw.startswith(self.MAGIC):
+                raise ValueError("неизвестный формат")
+            header = marshal.loads(raw[len(self.MAGIC):])
+            # Формат marshal зависит от версии Python
+            if header['python'] != tuple(sys.version_info[:2]):
+                logger.info("📦 Снимок состояния записан другой версией Python, используются JSON-файлы")
+                return
+            data = marshal.loads(header['data'])
+            self.sections = {name: (paths, header['signatures'][name], data[name]) for name, paths in header['paths'].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"⚠️ Снимок состояния не прочитан, используются JSON-файлы: {e}")
+        finally:
+            self.load_seconds = perf_counter() - started
+    
+    @staticmethod
+    def signature(paths: tuple) -> tuple:
+        result = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                result.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                result.append(None)
+        return tuple(result)
+    
+    def take(self, name: str) -> Any:
+        """Данные раздела, если его файлы не менялись после записи снимка; иначе None.
+        
+        Раздел без данных (например, рабочий чат не установлен) читается из JSON
+        и в sources отмечается как 'json'.
+        """
+        section = self.sections.pop(name, None)
+        if section is not None:
+            paths, signature, data = section
+            if data is not None and self.signature(paths) == signature:
+                self.sources[name] = 'snapshot'
+                return data
+        self.sources[name] = 'json'
+        return None
+    
+    def register(self, name: str, provider: Callable[[], Any], paths: tuple = None):
+        """Регистрирует раздел: provider возвращает данные, paths - файлы, которые они отражают"""
+        self.providers[name] = (tuple(paths or (name,)), provider)
+    
+    def save(self):
+        """Ставит запись снимка в очередь потока записи.
+        
+        Вызывается сразу после state_flusher.flush(): данные сериализуются сейчас и совпадают
+        с уже поставленными в очередь записями файлов, а размер/mtime файлов снимаются
+        потоком записи после этих записей.
+        """
+        if not self.enabled:
+            return
+        paths = {name: paths for name, (paths, _) in self.providers.items()}
+        data = marshal.dumps({name: provider() for name, (_, provider) in self.providers.items()})
+        
+        def write():
+            header = {
+                'python': tuple(sys.version_info[:2]),
+                'paths': paths,
+                'signatures': {name: self.signature(section_paths) for name, section_paths in paths.items()},
+                'data': data,
+            }
+            write_file_atomic(self.path, self.MAGIC + marshal.dumps(header))
+        
+        state_writer.submit(self.path, write)
+
+# ========== ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАПРОСОВ ==========
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+    
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 - токен есть)"""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Центральная очередь исходящих запросов к Bot API.
+    
+    Запрос получает разрешение, когда есть токен в общем bucket и в bucket его чата
+    (поканальные лимиты Telegram касаются только отправки новых сообщений, поэтому
+    удаления и правки учитываются лишь в общем bucket). Среди ожидающих первым идет
+    запрос с меньшим приоритетом (автоответы раньше отчетов).
+    Запрос, упершийся в лимит своего чата, не задерживает запросы в другие чаты.
+    При RetryAfter все запросы приостанавливаются на указанное Telegram время,
+    а сам запрос повторяется (не больше max_retries раз).
+    
+    Приоритет передается через rate_limit_args={'priority': ...} методов context.bot;
+    остальные запросы получают PRIORITY_COMMAND.
+    """
+    
+    # Сколько поканальных bucket хранить до очистки полностью восстановившихся
+    MAX_IDLE_BUCKETS = 1024
+    # Методы, публикующие сообщение в чат, помимо send*
+    CHAT_LIMITED_METHODS = {'forwardMessage', 'forwardMessages', 'copyMessage', 'copyMessages'}
+    
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, private_rate: float = OUTBOUND_PRIVATE_RATE,
+                 group_per_minute: float = OUTBOUND_GROUP_PER_MINUTE, chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_per_minute / 60
+        self.chat_burst = max(1, chat_burst)
+        self.max_retries = max_retries
+        self.global_bucket = None
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.waiting = []  # куча (priority, seq, chat_id, future)
+        self.counter = itertools.count()
+        self.retry_until = 0.0
+        self.wakeup = None
+    
+    async def initialize(self):
+        now = asyncio.get_running_loop().time()
+        self.global_bucket = TokenBucket(self.global_rate, max(1.0, self.global_rate), now)
+    
+    async def shutdown(self):
+        if self.wakeup:
+            self.wakeup.cancel()
+            self.wakeup = None
+        for _, _, _, future in self.waiting:
+            future.cancel()
+        self.waiting.clear()
+    
+    def chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_IDLE_BUCKETS:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full(now)}
+            # Группы и каналы: отрицательный ID или @username
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.private_rate, self.chat_burst, now)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    def schedule(self, delay: float):
+        loop = asyncio.get_running_loop()
+        self.wakeup = loop.call_later(delay, self.dispatch)
+    
+    def dispatch(self):
+        """Выдает разрешения ожидающим запросам в порядке приоритета"""
+        if self.wakeup:
+            self.wakeup.cancel()
+            self.wakeup = None
+        
+        now = asyncio.get_running_loop().time()
+        if now < self.retry_until:
+            self.schedule(self.retry_until - now)
+            return
+        
+        blocked = []
+        next_delay = None
+        while self.waiting:
+            entry = self.waiting[0]
+            future = entry[3]
+            if future.done():
+                # Ожидавший запрос отменен
+                heapq.heappop(self.waiting)
+                continue
+            
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                next_delay = global_delay if next_delay is None else min(next_delay, global_delay)
+                break
+            
+            heapq.heappop(self.waiting)
+            chat_id = entry[2]
+            bucket = self.chat_bucket(chat_id, now) if chat_id is not None else None
+            chat_delay = bucket.delay(now) if bucket else 0.0
+            if chat_delay > 0:
+                blocked.append(entry)
+                next_delay = chat_delay if next_delay is None else min(next_delay, chat_delay)
+                continue
+            
+            self.global_bucket.take()
+            if bucket:
+                bucket.take()
+            future.set_result(None)
+        
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+        if self.waiting and next_delay is not None:
+            self.schedule(next_delay)
+    
+    async def acquire(self, chat_id, priority: int):
+        """Ждет своей очереди на отправку запроса"""
+        if self.global_bucket is None:
+            await self.initialize()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), chat_id, future))
+        self.dispatch()
+        await future
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_COMMAND
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get('priority', PRIORITY_COMMAND)
+        elif isinstance(rate_limit_args, int):
+            priority = rate_limit_args
+        
+        chat_id = None
+        if endpoint.startswith('send') or endpoint in self.CHAT_LIMITED_METHODS:
+            chat_id = data.get('chat_id')
+        if chat_id is not None:
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                chat_id = str(chat_id)
+        
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                now = asyncio.get_running_loop().time()
+                self.retry_until = max(self.retry_until, now + e.retry_after + 0.1)
+                logger.warning(f"⏳ Flood control на {endpoint}: пауза {e.retry_after} сек., повтор {attempt + 1}/{self.max_retries}")
+
+# ========== HTTP-ТРАНСПОРТ ==========
+
+class EndpointStats:
+    """Счетчики запросов к одному методу Bot API"""
+    __slots__ = ('requests', 'errors', 'total_seconds', 'max_seconds', 'status_codes')
+    
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.status_codes: Dict[int, int] = {}
+
+class TransportStats:
+    """Задержки и ошибки запросов к Bot API по методам"""
+    
+    def __init__(self):
+        self.endpoints: Dict[str, EndpointStats] = {}
+    
+    def record(self, endpoint: str, seconds: float, status_code: int = None):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        stats.requests += 1
+        stats.total_seconds += seconds
+        if seconds > stats.max_seconds:
+            stats.max_seconds = seconds
+        # status_code=None - запрос не дошел до сервера (сеть, таймаут)
+        if status_code is None or status_code >= 400:
+            stats.errors += 1
+        if status_code is not None:
+            stats.status_codes[status_code] = stats.status_codes.get(status_code, 0) + 1
+    
+    def reset(self):
+        self.endpoints.clear()
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, считающий задержки и ошибки по методам Bot API"""
+    
+    def __init__(self, stats: TransportStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = perf_counter()
+        try:
+            status_code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            elapsed = perf_counter() - started
+            self.stats.record(endpoint, elapsed)
+            metrics.observe_api(endpoint, elapsed)
+            raise
+        elapsed = perf_counter() - started
+        self.stats.record(endpoint, elapsed, status_code)
+        metrics.observe_api(endpoint, elapsed, status_code)
+        return status_code, payload
+
+def resolve_http_version(requested: str) -> str:
+    """HTTP/2 только при установленном h2, иначе HTTP/1.1"""
+    if requested in ('2', '2.0'):
+        if importlib.util.find_spec('h2') is not None:
+            return '2'
+        logger.warning("⚠️ HTTP/2 недоступен (не установлен пакет h2), используется HTTP/1.1")
+    return '1.1'
+
+def create_http_requests(stats: TransportStats):
+    """Создает транспорт для отправки запросов и отдельный - для getUpdates"""
+    http_version = resolve_http_version(HTTP_VERSION)
+    request = InstrumentedHTTPXRequest(
+        stats,
+        connection_pool_size=max(1, HTTP_POOL_SIZE),
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=http_version
+    )
+    # Long polling держит соединение занятым, поэтому у него свой пул;
+    # к read_timeout PTB сам добавляет таймаут ожидания getUpdates
+    get_updates_request = InstrumentedHTTPXRequest(
+        stats,
+        connection_pool_size=max(1, HTTP_POLL_POOL_SIZE),
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=http_version
+    )
+    return request, get_updates_request
 
 # ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ ГЛАВНЫМ УВЕДОМЛЕНИЕМ ==========
 
@@ -47,9 +822,14 @@ class MasterNotificationManager:
         self.data = self.load_data()
         self.last_notification_time = None
         self.notification_cooldown = 1800  # 15 минут в секундах
+        state_flusher.register(MASTER_NOTIFICATION_FILE, self.save_data)
+        state_snapshot.register(MASTER_NOTIFICATION_FILE, lambda: self.data)
     
     def load_data(self) -> Dict[str, Any]:
         """Загружает данные главного уведомления из файла"""
+        data = state_snapshot.take(MASTER_NOTIFICATION_FILE)
+        if data is not None:
+            return data
         try:
             if os.path.exists(MASTER_NOTIFICATION_FILE):
                 with open(MASTER_NOTIFICATION_FILE, 'r') as f:
@@ -61,8 +841,7 @@ class MasterNotificationManager:
     def save_data(self):
         """Сохраняет данные главного уведомления в файл"""
         try:
-            with open(MASTER_NOTIFICATION_FILE, 'w') as f:
-                json.dump(self.data, f, indent=2)
+            state_writer.write_json(MASTER_NOTIFICATION_FILE, self.data, indent=2)
         except Exception as e:
             logger.error(f"Ошибка сохранения главного уведомления: {e}")
     
@@ -73,19 +852,28 @@ class MasterNotificationManager:
         
         self.data["message_ids"].append(message_id)
         self.data["last_update"] = datetime.now(MOSCOW_TZ).isoformat()
-        self.save_data()
+        state_flusher.mark_dirty(MASTER_NOTIFICATION_FILE)
         logger.info(f"✅ Добавлен ID уведомления: {message_id}")
     
     def get_message_ids(self) -> List[int]:
         """Возвращает список ID сообщений уведомлений"""
         return self.data.get("message_ids", [])
     
-    def clear_old_messages(self, keep_last: int = 3):
-        """Очищает старые сообщения, оставляя только последние"""
-        if "message_ids" in self.data and len(self.data["message_ids"]) > keep_last:
-            # Оставляем только последние keep_last сообщений
-            self.data["message_ids"] = self.data["message_ids"][-keep_last:]
-            self.save_data()
+    def remove_message_ids(self, message_ids: List[int]):
+        """Убирает из списка ID удаленных сообщений (остальные будут удалены при следующем обновлении)"""
+        removed = set(message_ids)
+        self.data["message_ids"] = [m for m in self.get_message_ids() if m not in removed]
+        state_flusher.mark_dirty(MASTER_NOTIFICATION_FILE)
+    
+    def get_last_digest(self) -> str:
+        """Хэш содержимого последнего уведомления (см. master_notification_digest)"""
+        return self.data.get("last_digest")
+    
+    def set_last_digest(self, digest: str):
+        self.data.pop("last_body", None)
+        self.data["last_digest"] = digest
+        self.data["last_update"] = datetime.now(MOSCOW_TZ).isoformat()
+        state_flusher.mark_dirty(MASTER_NOTIFICATION_FILE)
     
     def should_update(self) -> bool:
         """Проверяет, нужно ли обновлять уведомление (каждые 15 минут)"""
@@ -106,39 +894,56 @@ class MasterNotificationManager:
 # ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ СОСТОЯНИЕМ ВОРОНОК ==========
 
 class FunnelsStateManager:
+    """Состояние воронок: время последней проверки и обработанные сообщения.
+    
+    Обработанные сообщения хранятся словарем ключ -> время отметки (проверка за O(1));
+    отметки старше FUNNEL_STATE_TTL удаляются expire().
+    """
+    
     def __init__(self):
         self.state = self.load_state()
+        state_flusher.register(FUNNELS_STATE_FILE, self.save_state)
+        state_snapshot.register(FUNNELS_STATE_FILE, lambda: self.state)
     
     def load_state(self) -> Dict[str, Any]:
         """Загружает состояние воронок из файла"""
+        cached = state_snapshot.take(FUNNELS_STATE_FILE)
+        if cached is not None:
+            return cached
+        state = {
+            "last_funnel_1_check": None,
+            "last_funnel_2_check": None, 
+            "last_funnel_3_check": None,
+            "funnel_1_messages_processed": {},
+            "funnel_2_messages_processed": {},
+            "funnel_3_messages_processed": {}
+        }
         try:
             if os.path.exists(FUNNELS_STATE_FILE):
                 with open(FUNNELS_STATE_FILE, 'r') as f:
-                    return json.load(f)
+                    state.update(json.load(f))
         except Exception as e:
             logger.error(f"Ошибка загрузки состояния воронок: {e}")
         
-        return {
-            "last_funnel_1_check": None,
-            "last_funnel_2_check": None, 
-            "last_funnel_3_check": None,
-            "funnel_1_messages_processed": [],
-            "funnel_2_messages_processed": [],
-            "funnel_3_messages_processed": []
-        }
+        # Старый формат: список ключей; время отметки неизвестно, считаем текущим
+        now = int(unix_time())
+        for funnel_number in (1, 2, 3):
+            key = f"funnel_{funnel_number}_messages_processed"
+            if isinstance(state[key], list):
+                state[key] = {message_key: now for message_key in state[key]}
+        return state
     
     def save_state(self):
         """Сохраняет состояние воронок в файл"""
         try:
-            with open(FUNNELS_STATE_FILE, 'w') as f:
-                json.dump(self.state, f, indent=2, default=str)
+            state_writer.write_json(FUNNELS_STATE_FILE, self.state, indent=2, default=str)
         except Exception as e:
             logger.error(f"Ошибка сохранения состояния воронок: {e}")
     
     def update_last_check(self, funnel_number: int):
         """Обновляет время последней проверки для воронки"""
         self.state[f"last_funnel_{funnel_number}_check"] = datetime.now(MOSCOW_TZ).isoformat()
-        self.save_state()
+        state_flusher.mark_dirty(FUNNELS_STATE_FILE)
     
     def get_last_check(self, funnel_number: int) -> datetime:
         """Возвращает время последней проверки для воронки"""
@@ -148,31 +953,55 @@ class FunnelsStateManager:
         return datetime.now(MOSCOW_TZ) - timedelta(days=1)
     
     def add_processed_message(self, funnel_number: int, message_key: str):
-        """Добавляет сообщение в список обработанных для воронки"""
-        key = f"funnel_{funnel_number}_messages_processed"
-        if message_key not in self.state[key]:
-            self.state[key].append(message_key)
-            self.save_state()
+        """Добавляет сообщение в обработанные для воронки"""
+        processed = self.state[f"funnel_{funnel_number}_messages_processed"]
+        if message_key not in processed:
+            processed[message_key] = int(unix_time())
+            state_flusher.mark_dirty(FUNNELS_STATE_FILE)
     
     def is_message_processed(self, funnel_number: int, message_key: str) -> bool:
         """Проверяет, было ли сообщение уже обработано воронкой"""
-        key = f"funnel_{funnel_number}_messages_processed"
-        return message_key in self.state[key]
+        return message_key in self.state[f"funnel_{funnel_number}_messages_processed"]
     
     def clear_processed_messages(self, funnel_number: int):
-        """Очищает список обработанных сообщений для воронки"""
-        key = f"funnel_{funnel_number}_messages_processed"
-        self.state[key] = []
-        self.save_state()
+        """Очищает обработанные сообщения для воронки"""
+        self.state[f"funnel_{funnel_number}_messages_processed"] = {}
+        state_flusher.mark_dirty(FUNNELS_STATE_FILE)
+    
+    def expire(self) -> int:
+        """Удаляет отметки об обработке старше FUNNEL_STATE_TTL"""
+        cutoff = unix_time() - FUNNEL_STATE_TTL
+        removed = 0
+        for funnel_number in (1, 2, 3):
+            key = f"funnel_{funnel_number}_messages_processed"
+            processed = self.state[key]
+            kept = {message_key: marked_at for message_key, marked_at in processed.items() if marked_at > cutoff}
+            if len(kept) != len(processed):
+                removed += len(processed) - len(kept)
+                self.state[key] = kept
+        if removed:
+            state_flusher.mark_dirty(FUNNELS_STATE_FILE)
+        return removed
 
 # ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ ИСКЛЮЧЕНИЯМИ ==========
 
 class ExcludedUsersManager:
     def __init__(self):
         self.excluded_users = self.load_excluded_users()
+        # Множества для проверки за O(1); пересобираются только при изменении исключений
+        self.user_id_set = set()
+        self.username_set = set()
+        # Результаты проверки для последних апдейтов: update_id -> исключен ли отправитель
+        self.update_memo: "OrderedDict[int, bool]" = OrderedDict()
+        self.rebuild_lookup()
+        state_flusher.register(EXCLUDED_USERS_FILE, self.save_excluded_users)
+        state_snapshot.register(EXCLUDED_USERS_FILE, lambda: self.excluded_users)
     
     def load_excluded_users(self) -> Dict[str, Any]:
         """Загружает список исключенных пользователей из файла"""
+        data = state_snapshot.take(EXCLUDED_USERS_FILE)
+        if data is not None:
+            return data
         try:
             if os.path.exists(EXCLUDED_USERS_FILE):
                 with open(EXCLUDED_USERS_FILE, 'r') as f:
@@ -189,26 +1018,44 @@ class ExcludedUsersManager:
     def save_excluded_users(self):
         """Сохраняет список исключенных пользователей в файл"""
         try:
-            with open(EXCLUDED_USERS_FILE, 'w') as f:
-                json.dump(self.excluded_users, f, indent=2)
+            state_writer.write_json(EXCLUDED_USERS_FILE, self.excluded_users, indent=2)
         except Exception as e:
             logger.error(f"Ошибка сохранения исключенных пользователей: {e}")
     
+    def rebuild_lookup(self):
+        """Пересобирает множества для быстрой проверки и сбрасывает кэш апдейтов"""
+        self.user_id_set = set(self.excluded_users["user_ids"])
+        self.username_set = {u.lower() for u in self.excluded_users["usernames"]}
+        self.update_memo.clear()
+    
     def is_user_excluded(self, user_id: int, username: str = None) -> bool:
         """Проверяет, является ли пользователь исключенным"""
-        if user_id in self.excluded_users["user_ids"]:
+        if user_id in self.user_id_set:
             return True
         
-        if username and username.lower() in [u.lower() for u in self.excluded_users["usernames"]]:
+        if username and username.lower() in self.username_set:
             return True
         
         return False
     
+    def is_update_sender_excluded(self, update_id: int, user_id: int, username: str = None) -> bool:
+        """Проверяет отправителя апдейта один раз; повторные вызовы для того же апдейта берутся из кэша"""
+        cached = self.update_memo.get(update_id)
+        if cached is not None:
+            return cached
+        
+        result = self.is_user_excluded(user_id, username)
+        self.update_memo[update_id] = result
+        if len(self.update_memo) > EXCLUDED_MEMO_SIZE:
+            self.update_memo.popitem(last=False)
+        return result
+    
     def add_user_id(self, user_id: int) -> bool:
         """Добавляет ID пользователя в исключения"""
-        if user_id not in self.excluded_users["user_ids"]:
+        if user_id not in self.user_id_set:
             self.excluded_users["user_ids"].append(user_id)
-            self.save_excluded_users()
+            self.rebuild_lookup()
+            state_flusher.mark_dirty(EXCLUDED_USERS_FILE)
             logger.info(f"✅ Добавлен ID в исключения: {user_id}")
             return True
         return False
@@ -216,18 +1063,20 @@ class ExcludedUsersManager:
     def add_username(self, username: str) -> bool:
         """Добавляет username в исключения"""
         username = username.lstrip('@').lower()
-        if username not in [u.lower() for u in self.excluded_users["usernames"]]:
+        if username not in self.username_set:
             self.excluded_users["usernames"].append(username)
-            self.save_excluded_users()
+            self.rebuild_lookup()
+            state_flusher.mark_dirty(EXCLUDED_USERS_FILE)
             logger.info(f"✅ Добавлен username в исключения: @{username}")
             return True
         return False
     
     def remove_user_id(self, user_id: int) -> bool:
         """Удаляет ID пользователя из исключений"""
-        if user_id in self.excluded_users["user_ids"]:
+        if user_id in self.user_id_set:
             self.excluded_users["user_ids"].remove(user_id)
-            self.save_excluded_users()
+            self.rebuild_lookup()
+            state_flusher.mark_dirty(EXCLUDED_USERS_FILE)
             logger.info(f"✅ Удален ID из исключений: {user_id}")
             return True
         return False
@@ -238,11 +1087,17 @@ class ExcludedUsersManager:
         for u in self.excluded_users["usernames"]:
             if u.lower() == username:
                 self.excluded_users["usernames"].remove(u)
-                self.save_excluded_users()
+                self.rebuild_lookup()
+                state_flusher.mark_dirty(EXCLUDED_USERS_FILE)
                 logger.info(f"✅ Удален username из исключений: @{username}")
                 return True
         return False
     
+    def reload(self):
+        """Перечитывает исключения из файла (файл изменил другой процесс)"""
+        self.excluded_users = self.load_excluded_users()
+        self.rebuild_lookup()
+    
     def get_all_excluded(self) -> Dict[str, List]:
         """Возвращает всех исключенных пользователей"""
         return self.excluded_users
@@ -250,7 +1105,8 @@ class ExcludedUsersManager:
     def clear_all(self):
         """Очищает все исключения"""
         self.excluded_users = {"user_ids": [], "usernames": []}
-        self.save_excluded_users()
+        self.rebuild_lookup()
+        state_flusher.mark_dirty(EXCLUDED_USERS_FILE)
         logger.info("✅ Все исключения очищены")
 
 # ========== КЛАССЫ ДЛЯ УПРАВЛЕНИЯ ДАННЫМИ ==========
@@ -258,9 +1114,13 @@ class ExcludedUsersManager:
 class FunnelsConfig:
     def __init__(self):
         self.funnels = self.load_funnels()
+        state_snapshot.register(FUNNELS_CONFIG_FILE, lambda: self.funnels)
     
     def load_funnels(self) -> Dict[int, int]:
         """Загружает конфигурацию воронок из файла или использует значения по умолчания"""
+        data = state_snapshot.take(FUNNELS_CONFIG_FILE)
+        if data is not None:
+            return data
         try:
             if os.path.exists(FUNNELS_CONFIG_FILE):
                 with open(FUNNELS_CONFIG_FILE, 'r') as f:
@@ -278,11 +1138,14 @@ class FunnelsConfig:
     def save_funnels(self):
         """Сохраняет конфигурацию воронок в файл"""
         try:
-            with open(FUNNELS_CONFIG_FILE, 'w') as f:
-                json.dump(self.funnels, f, indent=2)
+            state_writer.write_json(FUNNELS_CONFIG_FILE, self.funnels, indent=2)
         except Exception as e:
             logger.error(f"Ошибка сохранения конфигурации воронок: {e}")
     
+    def reload(self):
+        """Перечитывает конфигурацию воронок из файла (файл изменил другой процесс)"""
+        self.funnels = self.load_funnels()
+    
     def get_funnels(self) -> Dict[int, int]:
         """Возвращает текущую конфигурацию воронок"""
         return self.funnels
@@ -306,41 +1169,180 @@ class FunnelsConfig:
         self.save_funnels()
         logger.info("Настройки воронок сброшены к значениям по умолчанию")
 
+class BusinessCalendar:
+    """Рабочее время: окна по дням недели (0 - понедельник) и праздничные дни.
+    
+    Формат business_calendar.json:
+    {"weekdays": {"0": [["10:00", "19:00"]], ..., "6": []}, "holidays": ["2026-01-01"]}
+    
+    Вычисленный отрезок [начало, конец) с постоянным статусом кэшируется, поэтому
+    проверка на каждое сообщение - одно сравнение; пересчет - только после конца отрезка.
+    """
+    
+    def __init__(self):
+        self.weekdays: Dict[int, List[tuple]] = {}
+        self.holidays = set()
+        self.segment = (0.0, 0.0, False)
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error(f"Ошибка в рабочем календаре, используются окна по умолчанию: {e}")
+            self.apply(self.default_calendar())
+    
+    @staticmethod
+    def default_calendar() -> Dict[str, Any]:
+        return {
+            "weekdays": {str(day): DEFAULT_BUSINESS_WINDOWS for day in range(5)},
+            "holidays": []
+        }
+    
+    def load_calendar(self) -> Dict[str, Any]:
+        try:
+            if os.path.exists(BUSINESS_CALENDAR_FILE):
+                with open(BUSINESS_CALENDAR_FILE, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки рабочего календаря: {e}")
+        
+        return self.default_calendar()
+    
+    @staticmethod
+    def parse_minutes(value: str) -> int:
+        """"10:30" -> 630 (допускается "24:00")"""
+        hours, minutes = value.split(':')
+        return int(hours) * 60 + int(minutes)
+    
+    def reload(self):
+        """Перечитывает календарь из файла"""
+        self.apply(self.load_calendar())
+    
+    def apply(self, data: Dict[str, Any]):
+        """Применяет настройки календаря и сбрасывает кэш текущего отрезка"""
+        weekdays = {}
+        for day in range(7):
+            windows = data.get("weekdays", {}).get(str(day), [])
+            parsed = sorted((self.parse_minutes(start), self.parse_minutes(end)) for start, end in windows)
+            weekdays[day] = [(start, end) for start, end in parsed if end > start]
+        self.weekdays = weekdays
+        self.holidays = {date.fromisoformat(day) for day in data.get("holidays", [])}
+        self.segment = (0.0, 0.0, False)
+        logger.info(f"📅 Рабочий календарь загружен: {sum(1 for windows in weekdays.values() if windows)} рабочих дней в неделе, {len(self.holidays)} праздников")
+    
+    def day_windows(self, day: date) -> List[tuple]:
+        if day in self.holidays:
+            return []
+        return self.weekdays[day.weekday()]
+    
+    @staticmethod
+    def boundary_ts(day: date, minutes: int) -> float:
+        day = day + timedelta(days=minutes // 1440)
+        minutes %= 1440
+        return MOSCOW_TZ.localize(datetime.combine(day, time(minutes // 60, minutes % 60))).timestamp()
+    
+    def compute_segment(self, now_ts: float) -> tuple:
+        """Отрезок (начало, конец, рабочий ли), содержащий момент now_ts"""
+        today = datetime.fromtimestamp(now_ts, MOSCOW_TZ).date()
+        previous = self.boundary_ts(today, 0)
+        for start_minutes, end_minutes in self.day_windows(today):
+            start = self.boundary_ts(today, start_minutes)
+            end = self.boundary_ts(today, end_minutes)
+            if now_ts < start:
+                return (previous, start, False)
+            if now_ts < end:
+                return (start, end, True)
+            previous = end
+        
+        # После последнего окна дня - до начала ближайшего рабочего дня
+        for offset in range(1, 367):
+            day = today + timedelta(days=offset)
+            windows = self.day_windows(day)
+            if windows:
+                return (previous, self.boundary_ts(day, windows[0][0]), False)
+        return (previous, float('inf'), False)
+    
+    def current_segment(self, now_ts: float = None) -> tuple:
+        if now_ts is None:
+            now_ts = unix_time()
+        start, end, _ = self.segment
+        if not start <= now_ts < end:
+            self.segment = self.compute_segment(now_ts)
+        return self.segment
+    
+    def is_working_time(self, now_ts: float = None) -> bool:
+        return self.current_segment(now_ts)[2]
+    
+    def next_boundary(self, now_ts: float = None) -> float:
+        """Момент ближайшей смены рабочего/нерабочего времени (inf, если рабочих окон нет)"""
+        return self.current_segment(now_ts)[1]
+
 class AutoReplyFlags:
+    """Флаги отправленных автоответов: ключ -> время установки (секунды epoch).
+    
+    Флаг старше AUTO_REPLY_FLAG_TTL считается снятым; такие записи периодически
+    удаляются expire(), чтобы файл не рос за счет давно не писавших чатов.
+    """
+    
     def __init__(self):
         self.flags = self.load_flags()
-    
-    def load_flags(self) -> Dict[str, bool]:
+        # Получатель изменений для синхронизации шардов: change_listener(key, value)
+        self.change_listener = None
+        state_flusher.register(FLAGS_FILE, self.save_flags)
+        state_snapshot.register(FLAGS_FILE, lambda: self.flags)
+    
+    def load_flags(self) -> Dict[str, int]:
+        data = state_snapshot.take(FLAGS_FILE)
+        if data is not None:
+            return data
         try:
             if os.path.exists(FLAGS_FILE):
                 with open(FLAGS_FILE, 'r') as f:
-                    return json.load(f)
+                    data = json.load(f)
+                # Старый формат: key -> True; время установки неизвестно, считаем текущим
+                now = int(unix_time())
+                return {key: (now if value is True else int(value)) for key, value in data.items() if value}
         except Exception as e:
             logger.error(f"Ошибка загрузки флагов: {e}")
         return {}
     
     def save_flags(self):
         try:
-            with open(FLAGS_FILE, 'w') as f:
-                json.dump(self.flags, f)
+            state_writer.write_json(FLAGS_FILE, self.flags)
         except Exception as e:
             logger.error(f"Ошибка сохранения флагов: {e}")
     
     def has_replied(self, key: str) -> bool:
-        return self.flags.get(key, False)
+        set_at = self.flags.get(key)
+        return set_at is not None and set_at > unix_time() - AUTO_REPLY_FLAG_TTL
     
     def set_replied(self, key: str):
-        self.flags[key] = True
-        self.save_flags()
+        set_at = int(unix_time())
+        self.flags[key] = set_at
+        state_flusher.mark_dirty(FLAGS_FILE)
+        if self.change_listener:
+            self.change_listener(key, set_at)
     
     def clear_replied(self, key: str):
         if key in self.flags:
             del self.flags[key]
-            self.save_flags()
+            state_flusher.mark_dirty(FLAGS_FILE)
+            if self.change_listener:
+                self.change_listener(key, None)
+    
+    def expire(self) -> int:
+        """Удаляет флаги старше AUTO_REPLY_FLAG_TTL"""
+        cutoff = unix_time() - AUTO_REPLY_FLAG_TTL
+        expired = [key for key, set_at in self.flags.items() if set_at <= cutoff]
+        for key in expired:
+            del self.flags[key]
+            if self.change_listener:
+                self.change_listener(key, None)
+        if expired:
+            state_flusher.mark_dirty(FLAGS_FILE)
+        return len(expired)
     
     def clear_all(self):
         self.flags = {}
-        self.save_flags()
+        state_flusher.mark_dirty(FLAGS_FILE)
     
     def count_flags(self):
         return len(self.flags)
@@ -348,8 +1350,12 @@ class AutoReplyFlags:
 class WorkChatManager:
     def __init__(self):
         self.work_chat_id = self.load_work_chat()
+        state_snapshot.register(WORK_CHAT_FILE, lambda: self.work_chat_id)
     
     def load_work_chat(self):
+        work_chat_id = state_snapshot.take(WORK_CHAT_FILE)
+        if work_chat_id is not None:
+            return work_chat_id
         try:
             if os.path.exists(WORK_CHAT_FILE):
                 with open(WORK_CHAT_FILE, 'r') as f:
@@ -361,8 +1367,7 @@ class WorkChatManager:
     
     def save_work_chat(self, chat_id):
         try:
-            with open(WORK_CHAT_FILE, 'w') as f:
-                json.dump({'work_chat_id': chat_id}, f)
+            state_writer.write_json(WORK_CHAT_FILE, {'work_chat_id': chat_id})
             self.work_chat_id = chat_id
             return True
         except Exception as e:
@@ -375,94 +1380,744 @@ class WorkChatManager:
     def is_work_chat_set(self):
         return self.work_chat_id is not None
 
-class PendingMessagesManager:
-    def __init__(self, funnels_config: FunnelsConfig):
-        self.pending_messages = self.load_pending_messages()
-        self.funnels_config = funnels_config
+def funnel_for_minutes(minutes_passed: int, funnels: Dict[int, int]) -> int:
+    """Определяет воронку по количеству минут без ответа"""
+    if minutes_passed >= funnels[3]:
+        return 3
+    elif minutes_passed >= funnels[2]:
+        return 2
+    elif minutes_passed >= funnels[1]:
+        return 1
+    return 0
+
+def intern_text(value: str = None) -> str:
+    """Интернирует повторяющиеся строки (название чата, username), чтобы записи делили одну копию"""
+    return sys.intern(value) if value else value
+
+class PendingMessage:
+    """Непрочитанное сообщение клиента.
+    
+    Время хранится в секундах epoch - ISO-строки разбираются только при загрузке старых файлов.
+    На диск запись сохраняется словарем to_dict() с теми же ключами, что и раньше.
+    """
+    
+    __slots__ = (
+        'key', 'chat_id', 'user_id', 'message_id', 'message_text', 'body_ref',
+        'chat_title', 'username', 'first_name', 'timestamp', 'funnels_sent', 'current_funnel'
+    )
+    
+    def __init__(self, key: str, chat_id: int, user_id: int, message_id: int, message_text: str,
+                 timestamp: int, chat_title: str = None, username: str = None, first_name: str = None,
+                 funnels_sent: List[int] = None, current_funnel: int = 0, body_ref: str = None):
+        self.key = key
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+        # Текст или его начало (по MESSAGE_BODY_POLICY); при хранении в файле - ссылка body_ref
+        self.message_text = message_text
+        self.body_ref = body_ref
+        self.chat_title = intern_text(chat_title)
+        self.username = intern_text(username)
+        self.first_name = intern_text(first_name)
+        self.timestamp = timestamp
+        self.funnels_sent = funnels_sent or []
+        self.current_funnel = current_funnel
+    
+    def minutes_passed(self, now_ts: float) -> int:
+        return int((now_ts - self.timestamp) / 60)
+    
+    async def get_text(self) -> str:
+        """Текст сообщения; вынесенный в отдельный файл читается только по запросу"""
+        if self.body_ref:
+            return await message_body_store.get(self.body_ref)
+        return self.message_text
+    
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            'chat_id': self.chat_id,
+            'user_id': self.user_id,
+            'message_id': self.message_id,
+            'chat_title': self.chat_title,
+            'username': self.username,
+            'first_name': self.first_name,
+            'timestamp': self.timestamp,
+            'funnels_sent': self.funnels_sent,
+            'current_funnel': self.current_funnel
+        }
+        if self.message_text is not None:
+            data['message_text'] = self.message_text
+        if self.body_ref:
+            data['message_body'] = self.body_ref
+        return data
+    
+    def to_record(self) -> tuple:
+        """Компактная запись для бинарного снимка (порядок аргументов конструктора)"""
+        return (self.key, self.chat_id, self.user_id, self.message_id, self.message_text, self.timestamp,
+                self.chat_title, self.username, self.first_name, self.funnels_sent, self.current_funnel, self.body_ref)
+    
+    @classmethod
+    def from_record(cls, record: tuple) -> 'PendingMessage':
+        return cls(*record)
+    
+    @classmethod
+    def from_dict(cls, key: str, data: Dict[str, Any]) -> 'PendingMessage':
+        timestamp = data['timestamp']
+        if isinstance(timestamp, str):
+            # Старый формат: ISO-строка
+            timestamp = int(datetime.fromisoformat(timestamp).timestamp())
+        return cls(
+            key=key,
+            chat_id=data['chat_id'],
+            user_id=data['user_id'],
+            message_id=data.get('message_id'),
+            message_text=data.get('message_text'),
+            timestamp=timestamp,
+            chat_title=data.get('chat_title'),
+            username=data.get('username'),
+            first_name=data.get('first_name'),
+            funnels_sent=list(data.get('funnels_sent', [])),
+            current_funnel=data.get('current_funnel', 0),
+            body_ref=data.get('message_body')
+        )
+
+class ChatAggregate:
+    """Сводка по чату для отчетов: поддерживается менеджером при каждом изменении сообщений"""
+    
+    __slots__ = ('chat_id', 'chat_title', 'message_count', 'oldest_time', 'funnel_counts')
+    
+    def __init__(self, chat_id: int, chat_title: str = None):
+        self.chat_id = chat_id
+        self.chat_title = chat_title
+        self.message_count = 0
+        self.oldest_time = None
+        # Количество сообщений чата в каждой воронке (0-3)
+        self.funnel_counts = [0, 0, 0, 0]
+    
+    @property
+    def current_funnel(self) -> int:
+        """Максимальная воронка среди сообщений чата"""
+        for funnel in (3, 2, 1):
+            if self.funnel_counts[funnel]:
+                return funnel
+        return 0
+
+class MessageBodyStore:
+    """Тексты сообщений по MESSAGE_BODY_POLICY.
+    
+    В режиме "external" каждый уникальный текст записывается один раз в файл,
+    названный SHA-256 содержимого; в состоянии остается только эта ссылка.
+    """
+    
+    def __init__(self, policy: str, directory: str):
+        if policy not in ('full', 'preview', 'none', 'external'):
+            logger.warning(f"⚠️ Неизвестная политика MESSAGE_BODY_POLICY={policy}, используется full")
+            policy = 'full'
+        self.policy = policy
+        self.directory = directory
+        # Хэши текстов, файлы которых уже есть на диске или стоят в очереди на запись
+        self.known = set()
+        if policy == 'external' and os.path.isdir(directory):
+            self.known = set(os.listdir(directory))
+    
+    def prepare(self, text: str):
+        """Возвращает (текст для состояния, ссылка на файл) согласно политике"""
+        if not text or self.policy == 'full':
+            return text, None
+        if self.policy == 'none':
+            return None, None
+        if self.policy == 'preview':
+            if len(text) <= MESSAGE_PREVIEW_LENGTH:
+                return text, None
+            return text[:MESSAGE_PREVIEW_LENGTH] + "…", None
+        return None, self.put(text)
+    
+    def put(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if digest not in self.known:
+            if not self.known:
+                # Каталог создается в потоке записи, до первой записи текста
+                directory = self.directory
+                state_writer.submit(directory, lambda: os.makedirs(directory, exist_ok=True))
+            state_writer.write_text(os.path.join(self.directory, digest), text)
+            self.known.add(digest)
+        return digest
+    
+    async def get(self, digest: str) -> str:
+        """Текст по ссылке; файл читается в отдельном потоке, event loop не блокируется"""
+        path = os.path.join(self.directory, digest)
+        
+        def read():
+            # Файл мог еще стоять в очереди записи - дожидаемся ее в этом же потоке
+            if not os.path.exists(path):
+                state_writer.wait()
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return f.read()
+            except OSError:
+                return None
+        
+        return await asyncio.to_thread(read)
+    
+    def collect_garbage(self, referenced: set) -> int:
+        """Удаляет файлы текстов, на которые больше не ссылается ни одно сообщение"""
+        unused = self.known - referenced
+        if not unused:
+            return 0
+        self.known -= unused
+        paths = [os.path.join(self.directory, digest) for digest in unused]
+        
+        def remove_files():
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        
+        # Через поток записи: удаление выполнится после уже поставленных в очередь записей
+        state_writer.submit(self.directory, remove_files)
+        return len(unused)
+
+# ========== ХРАНИЛИЩА НЕПРОЧИТАННЫХ СООБЩЕНИЙ ==========
+
+class JsonPendingStorage:
+    """Хранение в pending_messages.json: полный снимок + журнал изменений"""
+    
+    def __init__(self):
+        self.journal_records = 0
+        self.journal_buffer: List[Dict[str, Any]] = []
     
-    def load_pending_messages(self) -> Dict[str, Any]:
+    def load(self) -> Dict[str, Any]:
+        messages = {}
         try:
             if os.path.exists(PENDING_MESSAGES_FILE):
                 with open(PENDING_MESSAGES_FILE, 'r') as f:
-                    return json.load(f)
+                    messages = json.load(f)
         except Exception as e:
             logger.error(f"Ошибка загрузки непрочитанных сообщений: {e}")
-        return {}
+        
+        if PENDING_JOURNAL_ENABLED:
+            self.journal_records = self.replay_journal(messages)
+            if self.journal_records:
+                logger.info(f"📜 Применено записей журнала: {self.journal_records}")
+        return messages
+    
+    def replay_journal(self, messages: Dict[str, Any]) -> int:
+        """Применяет записи журнала поверх загруженного снимка.
+        
+        Записи идемпотентны (установка/удаление по ключу), поэтому повторное применение
+        журнала к снимку, который уже содержит эти изменения, дает тот же результат.
+        Недописанный хвост после аварийной остановки отрезается, чтобы новые записи
+        не оказались за поврежденной строкой и не терялись при каждом следующем запуске.
+        """
+        count = 0
+        try:
+            if not os.path.exists(PENDING_JOURNAL_FILE):
+                return 0
+            good_offset = 0
+            damaged = False
+            last_line = b''
+            with open(PENDING_JOURNAL_FILE, 'rb') as f:
+                for last_line in f:
+                    line = last_line.strip()
+                    if line:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            damaged = True
+                            break
+                        self.apply_journal_record(messages, record)
+                        count += 1
+                    good_offset += len(last_line)
+            
+            if damaged:
+                with open(PENDING_JOURNAL_FILE, 'r+b') as f:
+                    f.truncate(good_offset)
+                logger.warning(f"⚠️ Поврежденная запись журнала отрезана, применено записей: {count}")
+            elif last_line and not last_line.endswith(b'\n'):
+                # Последняя запись цела, но без перевода строки - следующая запись начнется с новой строки
+                with open(PENDING_JOURNAL_FILE, 'ab') as f:
+                    f.write(b'\n')
+        except Exception as e:
+            logger.error(f"Ошибка чтения журнала непрочитанных сообщений: {e}")
+        return count
     
-    def save_pending_messages(self):
+    @staticmethod
+    def apply_journal_record(messages: Dict[str, Any], record: Dict[str, Any]):
+        op = record.get('op')
+        if op == 'set':
+            messages[record['key']] = record['message']
+        elif op == 'delete':
+            for key in record['keys']:
+                messages.pop(key, None)
+    
+    def needs_compaction(self) -> bool:
+        return self.journal_records >= PENDING_JOURNAL_COMPACT_EVERY
+    
+    def record_set(self, key: str, message: Dict[str, Any]):
+        if PENDING_JOURNAL_ENABLED:
+            self.journal_buffer.append({'op': 'set', 'key': key, 'message': message})
+    
+    def record_delete(self, keys: List[str]):
+        if PENDING_JOURNAL_ENABLED:
+            self.journal_buffer.append({'op': 'delete', 'keys': keys})
+    
+    def flush(self, snapshot: Callable[[], Dict[str, Any]]):
+        """Дописывает накопленные записи в журнал одним блоком (или сохраняет снимок, если журнал выключен)"""
+        if not PENDING_JOURNAL_ENABLED:
+            self.save_all(snapshot())
+            return
+        if not self.journal_buffer:
+            return
+        
+        records, self.journal_buffer = self.journal_buffer, []
         try:
-            with open(PENDING_MESSAGES_FILE, 'w') as f:
-                json.dump(self.pending_messages, f, indent=2)
+            state_writer.append_text(
+                PENDING_JOURNAL_FILE,
+                "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            )
+            self.journal_records += len(records)
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала непрочитанных сообщений: {e}")
+            self.save_all(snapshot())
+            return
+        
+        if self.needs_compaction():
+            self.save_all(snapshot())
+    
+    def save_all(self, messages: Dict[str, Any]):
+        """Сохраняет полный снимок и очищает журнал (компактификация)"""
+        try:
+            state_writer.write_json(PENDING_MESSAGES_FILE, messages, indent=2)
+            if PENDING_JOURNAL_ENABLED:
+                # Поток записи выполняет задачи по порядку: журнал очищается только после снимка
+                state_writer.write_text(PENDING_JOURNAL_FILE, "")
+            self.journal_buffer = []
+            if self.journal_records:
+                logger.info(f"🗜 Журнал непрочитанных сообщений сжат ({self.journal_records} записей)")
+            self.journal_records = 0
         except Exception as e:
             logger.error(f"Ошибка сохранения непрочитанных сообщений: {e}")
+
+class SqlitePendingStorage:
+    """Хранение в SQLite (WAL): каждое изменение - вставка или удаление отдельных строк.
+    
+    Соединение для записи используется только потоком state_writer. Обработчики читают
+    копию в памяти: запрос к базе из event loop блокировал бы его и не видел бы записей,
+    еще стоящих в очереди. Индексы по chat_id и ts нужны загрузке (ORDER BY ts)
+    и запросам напрямую к файлу базы.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pending_messages (
+            message_key TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            current_funnel INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_pending_messages_chat ON pending_messages (chat_id);
+        CREATE INDEX IF NOT EXISTS idx_pending_messages_ts ON pending_messages (ts);
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self.pending_ops: List[tuple] = []
+    
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(self.SCHEMA)
+        return connection
+    
+    def load(self) -> Dict[str, Any]:
+        messages = {}
+        try:
+            connection = self.connect()
+            try:
+                rows = connection.execute("SELECT message_key, data FROM pending_messages ORDER BY ts")
+                messages = {key: json.loads(data) for key, data in rows}
+            finally:
+                connection.close()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки непрочитанных сообщений из SQLite: {e}")
+            return messages
+        
+        # Первый запуск с SQLite: переносим данные из JSON-хранилища один раз
+        if not messages and (os.path.exists(PENDING_MESSAGES_FILE) or os.path.exists(PENDING_JOURNAL_FILE)):
+            messages = {
+                key: PendingMessage.from_dict(key, data).to_dict()
+                for key, data in JsonPendingStorage().load().items()
+            }
+            rows = [self.make_row(key, message) for key, message in messages.items()]
+            state_writer.submit(self.path, lambda: self.migrate_from_json(rows))
+            logger.info(f"📦 Перенесено в SQLite непрочитанных сообщений: {len(messages)}")
+        return messages
+    
+    def migrate_from_json(self, rows: List[tuple]):
+        """Записывает перенесенные сообщения и переименовывает JSON-файлы, чтобы перенос не повторился.
+        
+        Файлы переименовываются только после фиксации транзакции: при сбое до нее
+        перенос просто выполнится снова при следующем запуске.
+        """
+        self.replace_all(rows)
+        for path in (PENDING_MESSAGES_FILE, PENDING_JOURNAL_FILE):
+            if os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+    
+    @staticmethod
+    def make_row(key: str, message: Dict[str, Any]) -> tuple:
+        return (
+            key,
+            message['chat_id'],
+            message['user_id'],
+            message['timestamp'],
+            message.get('current_funnel', 0),
+            json.dumps(message, ensure_ascii=False)
+        )
+    
+    def needs_compaction(self) -> bool:
+        return False
+    
+    def record_set(self, key: str, message: Dict[str, Any]):
+        self.pending_ops.append(('set', key, message))
+    
+    def record_delete(self, keys: List[str]):
+        self.pending_ops.append(('delete', keys, None))
+    
+    def flush(self, snapshot: Callable[[], Dict[str, Any]]):
+        if not self.pending_ops:
+            return
+        ops, self.pending_ops = self.pending_ops, []
+        # Строки сериализуются здесь, в потоке обработчиков, - в поток записи уходит неизменяемый снимок
+        prepared = []
+        for op, target, message in ops:
+            if op == 'set':
+                prepared.append(('set', self.make_row(target, message)))
+            else:
+                prepared.append(('delete', [(key,) for key in target]))
+        state_writer.submit(self.path, lambda: self.apply_ops(prepared))
+    
+    def save_all(self, messages: Dict[str, Any]):
+        rows = [self.make_row(key, message) for key, message in messages.items()]
+        self.pending_ops = []
+        state_writer.submit(self.path, lambda: self.replace_all(rows))
+    
+    def get_connection(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection
+    
+    def apply_ops(self, prepared: List[tuple]):
+        connection = self.get_connection()
+        with connection:
+            for op, payload in prepared:
+                if op == 'set':
+                    connection.execute("INSERT OR REPLACE INTO pending_messages VALUES (?, ?, ?, ?, ?, ?)", payload)
+                else:
+                    connection.executemany("DELETE FROM pending_messages WHERE message_key = ?", payload)
+    
+    def replace_all(self, rows: List[tuple]):
+        connection = self.get_connection()
+        with connection:
+            connection.execute("DELETE FROM pending_messages")
+            connection.executemany("INSERT INTO pending_messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+class MirrorPendingStorage:
+    """Пустое хранилище процесса-приемника: сообщения хранят и записывают на диск шарды"""
+    
+    def load(self) -> Dict[str, Any]:
+        return {}
+    
+    def needs_compaction(self) -> bool:
+        return False
+    
+    def record_set(self, key: str, message: Dict[str, Any]):
+        pass
+    
+    def record_delete(self, keys: List[str]):
+        pass
+    
+    def flush(self, snapshot: Callable[[], Dict[str, Any]]):
+        pass
+    
+    def save_all(self, messages: Dict[str, Any]):
+        pass
+
+def create_pending_storage():
+    """Создает хранилище непрочитанных сообщений согласно PENDING_STORAGE"""
+    if IS_SHARD_INGEST:
+        return MirrorPendingStorage()
+    if PENDING_STORAGE == 'sqlite':
+        return SqlitePendingStorage(PENDING_DB_FILE)
+    if PENDING_STORAGE != 'json':
+        logger.warning(f"⚠️ Неизвестное хранилище PENDING_STORAGE={PENDING_STORAGE}, используется json")
+    return JsonPendingStorage()
+
+class PendingMessagesManager:
+    def __init__(self, funnels_config: FunnelsConfig):
+        self.storage = create_pending_storage()
+        self.pending_messages = self.load_pending_messages()
+        self.funnels_config = funnels_config
+        # Вторичный индекс: chat_id -> ключи сообщений этого чата
+        self.chat_index: Dict[int, set] = {}
+        # Сводки по чатам для отчетов и отсортированные времена всех сообщений
+        self.chat_aggregates: Dict[int, ChatAggregate] = {}
+        self.timeline: List[int] = []
+        # Очередь проверок воронок: (момент следующего пересечения порога, ключ)
+        self.funnel_deadlines: List[tuple] = []
+        self.funnel_due: Dict[str, float] = {}
+        self.deadlines_config = None
+        # Получатель изменений для синхронизации шардов: change_listener(op, *args)
+        self.change_listener = None
+        self.rebuild_indexes()
+        state_flusher.register(PENDING_MESSAGES_FILE, self.flush_storage)
+        if isinstance(self.storage, JsonPendingStorage):
+            state_snapshot.register(PENDING_MESSAGES_FILE, self.snapshot_state, (PENDING_MESSAGES_FILE, PENDING_JOURNAL_FILE))
+        
+        converted = self.apply_body_policy()
+        if converted or self.storage.needs_compaction():
+            self.save_pending_messages()
+    
+    def load_pending_messages(self) -> Dict[str, PendingMessage]:
+        if isinstance(self.storage, JsonPendingStorage):
+            cached = state_snapshot.take(PENDING_MESSAGES_FILE)
+            if cached is not None:
+                self.storage.journal_records = cached['journal_records']
+                return {record[0]: PendingMessage.from_record(record) for record in cached['records']}
+        
+        messages = {}
+        for key, data in self.storage.load().items():
+            try:
+                messages[key] = PendingMessage.from_dict(key, data)
+            except Exception as e:
+                logger.error(f"Ошибка чтения непрочитанного сообщения {key}: {e}")
+        return messages
+    
+    def apply_body_policy(self) -> int:
+        """Приводит тексты загруженных сообщений к текущей MESSAGE_BODY_POLICY"""
+        if message_body_store.policy == 'full':
+            return 0
+        converted = 0
+        for message in self.pending_messages.values():
+            if message.message_text is None:
+                continue
+            message_text, body_ref = message_body_store.prepare(message.message_text)
+            if message_text != message.message_text or body_ref:
+                message.message_text = message_text
+                message.body_ref = body_ref
+                converted += 1
+        if converted:
+            logger.info(f"✂️ Тексты {converted} сообщений приведены к политике {message_body_store.policy}")
+        return converted
+    
+    def collect_message_bodies(self) -> int:
+        """Удаляет файлы текстов удаленных сообщений"""
+        referenced = {message.body_ref for message in self.pending_messages.values() if message.body_ref}
+        return message_body_store.collect_garbage(referenced)
+    
+    def rebuild_indexes(self):
+        """Строит индексы заново по всем сообщениям"""
+        self.chat_index = {}
+        self.chat_aggregates = {}
+        for key, message in self.pending_messages.items():
+            self.chat_index.setdefault(message.chat_id, set()).add(key)
+            self.aggregate_add(message)
+        self.timeline = sorted(message.timestamp for message in self.pending_messages.values())
+        self.rebuild_funnel_deadlines()
+    
+    def aggregate_add(self, message: PendingMessage):
+        aggregate = self.chat_aggregates.get(message.chat_id)
+        if aggregate is None:
+            aggregate = self.chat_aggregates[message.chat_id] = ChatAggregate(message.chat_id, message.chat_title)
+        aggregate.message_count += 1
+        aggregate.funnel_counts[message.current_funnel] += 1
+        if aggregate.oldest_time is None or message.timestamp < aggregate.oldest_time:
+            aggregate.oldest_time = message.timestamp
+    
+    def aggregate_remove(self, message: PendingMessage):
+        aggregate = self.chat_aggregates[message.chat_id]
+        aggregate.message_count -= 1
+        if not aggregate.message_count:
+            del self.chat_aggregates[message.chat_id]
+            return
+        aggregate.funnel_counts[message.current_funnel] -= 1
+        if message.timestamp == aggregate.oldest_time:
+            # Пересчет только по сообщениям этого чата
+            aggregate.oldest_time = min(self.pending_messages[key].timestamp for key in self.chat_index[message.chat_id])
+    
+    def set_message_funnel(self, message: PendingMessage, funnel_number: int):
+        """Меняет воронку сообщения, обновляя сводку чата"""
+        funnel_counts = self.chat_aggregates[message.chat_id].funnel_counts
+        funnel_counts[message.current_funnel] -= 1
+        funnel_counts[funnel_number] += 1
+        message.current_funnel = funnel_number
+    
+    def rebuild_funnel_deadlines(self):
+        """Заново строит очередь проверок воронок (при загрузке и смене настроек воронок)"""
+        self.deadlines_config = tuple(sorted(self.funnels_config.get_funnels().items()))
+        self.funnel_due = {key: self.first_funnel_check(key) for key in self.pending_messages}
+        self.funnel_deadlines = [(due, key) for key, due in self.funnel_due.items()]
+        heapq.heapify(self.funnel_deadlines)
+    
+    def first_funnel_check(self, key: str) -> float:
+        """Момент первой проверки: сразу, если воронка уже выставлена, иначе - первый порог"""
+        message = self.pending_messages[key]
+        if message.current_funnel:
+            return 0
+        return message.timestamp + min(self.funnels_config.get_funnels().values()) * 60
+    
+    def schedule_funnel_check(self, key: str, due: float):
+        self.funnel_due[key] = due
+        heapq.heappush(self.funnel_deadlines, (due, key))
+    
+    def next_funnel_crossing(self, key: str, now_ts: float):
+        """Ближайший будущий момент, когда у сообщения может смениться воронка"""
+        timestamp = self.pending_messages[key].timestamp
+        crossings = [timestamp + minutes * 60 for minutes in self.funnels_config.get_funnels().values()]
+        future = [crossing for crossing in crossings if crossing > now_ts]
+        return min(future) if future else None
+    
+    def store_message(self, message: PendingMessage):
+        """Сохраняет сообщение в памяти и обновляет индексы"""
+        key = message.key
+        if key in self.pending_messages:
+            self.drop_message(key)
+        self.pending_messages[key] = message
+        self.chat_index.setdefault(message.chat_id, set()).add(key)
+        self.aggregate_add(message)
+        bisect.insort(self.timeline, message.timestamp)
+        self.schedule_funnel_check(key, self.first_funnel_check(key))
+    
+    def drop_message(self, key: str) -> PendingMessage:
+        """Удаляет сообщение из памяти и из индексов"""
+        message = self.pending_messages.pop(key)
+        chat_keys = self.chat_index.get(message.chat_id)
+        if chat_keys is not None:
+            chat_keys.discard(key)
+            if not chat_keys:
+                del self.chat_index[message.chat_id]
+        self.aggregate_remove(message)
+        del self.timeline[bisect.bisect_left(self.timeline, message.timestamp)]
+        # Запись в очереди проверок удаляется лениво при извлечении
+        self.funnel_due.pop(key, None)
+        return message
+    
+    def record_set(self, key: str):
+        """Фиксирует добавление/изменение сообщения; на диск его записывает state_flusher"""
+        data = self.pending_messages[key].to_dict()
+        self.storage.record_set(key, data)
+        state_flusher.mark_dirty(PENDING_MESSAGES_FILE)
+        if self.change_listener:
+            self.change_listener('set', key, data)
+    
+    def record_delete(self, keys: List[str]):
+        """Фиксирует удаление сообщений; на диск его записывает state_flusher"""
+        self.storage.record_delete(keys)
+        state_flusher.mark_dirty(PENDING_MESSAGES_FILE)
+        if self.change_listener:
+            self.change_listener('delete', keys)
+    
+    def encode_all(self) -> Dict[str, Dict[str, Any]]:
+        return {key: message.to_dict() for key, message in self.pending_messages.items()}
+    
+    def snapshot_state(self) -> Dict[str, Any]:
+        """Раздел бинарного снимка: сообщения и число записей журнала (для решения о компактификации)"""
+        return {
+            'records': [message.to_record() for message in self.pending_messages.values()],
+            'journal_records': self.storage.journal_records
+        }
+    
+    def flush_storage(self):
+        self.storage.flush(self.encode_all)
+    
+    def save_pending_messages(self):
+        """Сохраняет все сообщения целиком"""
+        self.storage.save_all(self.encode_all())
     
     def add_message(self, chat_id: int, user_id: int, message_text: str, message_id: int, chat_title: str = None, username: str = None, first_name: str = None):
         key = f"{chat_id}_{user_id}_{message_id}_{int(datetime.now().timestamp())}"
         
         if not message_text:
             message_text = "[Сообщение без текста]"
+        message_text, body_ref = message_body_store.prepare(message_text)
         
-        self.pending_messages[key] = {
-            'chat_id': chat_id,
-            'user_id': user_id,
-            'message_text': message_text,
-            'message_id': message_id,
-            'chat_title': chat_title,
-            'username': username,
-            'first_name': first_name,
-            'timestamp': datetime.now(MOSCOW_TZ).isoformat(),
-            'funnels_sent': [],
-            'current_funnel': 0,
-            'message_key': key
-        }
-        self.save_pending_messages()
+        self.store_message(PendingMessage(
+            key=key,
+            chat_id=chat_id,
+            user_id=user_id,
+            message_id=message_id,
+            message_text=message_text,
+            body_ref=body_ref,
+            timestamp=int(datetime.now(MOSCOW_TZ).timestamp()),
+            chat_title=chat_title,
+            username=username,
+            first_name=first_name
+        ))
+        self.record_set(key)
         logger.info(f"✅ Добавлено непрочитанное сообщение: {key}")
     
     def remove_message_by_key(self, key: str):
         if key in self.pending_messages:
-            del self.pending_messages[key]
-            self.save_pending_messages()
+            self.drop_message(key)
+            self.record_delete([key])
             logger.info(f"✅ Удалено непрочитанное сообщение: {key}")
             return True
         return False
     
     def remove_all_chat_messages(self, chat_id: int, user_id: int = None):
         keys_to_remove = []
-        for key, message in self.pending_messages.items():
-            if message['chat_id'] == chat_id:
-                if user_id is None or message['user_id'] == user_id:
-                    keys_to_remove.append(key)
+        for key in self.chat_index.get(chat_id, ()):
+            if user_id is None or self.pending_messages[key].user_id == user_id:
+                keys_to_remove.append(key)
         
         for key in keys_to_remove:
-            del self.pending_messages[key]
+            self.drop_message(key)
         
         if keys_to_remove:
-            self.save_pending_messages()
+            self.record_delete(keys_to_remove)
             logger.info(f"✅ Удалено {len(keys_to_remove)} сообщений из чата {chat_id}")
             return len(keys_to_remove)
         return 0
     
-    def get_all_pending_messages(self) -> List[Dict[str, Any]]:
+    def get_all_pending_messages(self) -> List[PendingMessage]:
         return list(self.pending_messages.values())
     
+    def count_messages(self) -> int:
+        return len(self.pending_messages)
+    
+    def get_chat_aggregates(self) -> Dict[int, ChatAggregate]:
+        """Сводки по чатам (chat_id -> ChatAggregate), без перебора сообщений"""
+        return self.chat_aggregates
+    
+    def count_chats_by_funnel(self) -> Dict[int, int]:
+        counts = {0: 0, 1: 0, 2: 0, 3: 0}
+        for aggregate in self.chat_aggregates.values():
+            counts[aggregate.current_funnel] += 1
+        return counts
+    
+    def count_messages_older_than(self, seconds: float, now_ts: float) -> int:
+        """Количество сообщений старше указанного возраста (бинарный поиск по отсортированным временам)"""
+        return bisect.bisect_right(self.timeline, now_ts - seconds)
+    
     def mark_funnel_sent(self, message_key: str, funnel_number: int):
         if message_key in self.pending_messages:
-            if funnel_number not in self.pending_messages[message_key]['funnels_sent']:
-                self.pending_messages[message_key]['funnels_sent'].append(funnel_number)
-                self.pending_messages[message_key]['current_funnel'] = funnel_number
-                self.save_pending_messages()
+            message = self.pending_messages[message_key]
+            if funnel_number not in message.funnels_sent:
+                message.funnels_sent.append(funnel_number)
+                self.set_message_funnel(message, funnel_number)
+                self.record_set(message_key)
+                self.schedule_funnel_check(message_key, 0)
     
-    def find_messages_by_chat(self, chat_id: int) -> List[Dict[str, Any]]:
-        result = []
-        for message in self.pending_messages.values():
-            if message['chat_id'] == chat_id:
-                result.append(message)
-        return result
+    def find_messages_by_chat(self, chat_id: int) -> List[PendingMessage]:
+        return [self.pending_messages[key] for key in self.chat_index.get(chat_id, ())]
     
-    def get_messages_for_funnel(self, funnel_number: int, funnels_state: FunnelsStateManager) -> List[Dict[str, Any]]:
+    def get_messages_for_funnel(self, funnel_number: int, funnels_state: FunnelsStateManager) -> List[PendingMessage]:
         """Получает сообщения для указанной воронки - ПРОСТАЯ И НАДЕЖНАЯ ЛОГИКА"""
         result = []
-        now = datetime.now(MOSCOW_TZ)
+        now_ts = datetime.now(MOSCOW_TZ).timestamp()
         FUNNELS = self.funnels_config.get_funnels()
         funnel_minutes = FUNNELS[funnel_number]
         
@@ -471,67 +2126,69 @@ class PendingMessagesManager:
             # if funnels_state.is_message_processed(funnel_number, message_key):
             #     continue
                 
-            timestamp = datetime.fromisoformat(message['timestamp'])
-            time_diff = now - timestamp
-            minutes_passed = int(time_diff.total_seconds() / 60)
-            
-            funnels_sent = message.get('funnels_sent', [])
+            minutes_passed = message.minutes_passed(now_ts)
             
             # ПРОСТАЯ ЛОГИКА: если прошло достаточно времени и воронка еще не отправлена
             if (minutes_passed >= funnel_minutes and 
-                funnel_number not in funnels_sent):
-                message['message_key'] = message_key
-                message['minutes_passed'] = minutes_passed
+                funnel_number not in message.funnels_sent):
                 result.append(message)
         
         return result
     
-    def update_funnel_statuses(self):
-        """Автоматически обновляет статусы воронок - ПРОСТАЯ ЛОГИКА"""
+    def update_funnel_statuses(self, full: bool = False):
+        """Автоматически обновляет статусы воронок.
+        
+        Проверяются только сообщения, у которых наступил момент пересечения порога воронки;
+        full=True (или смена настроек воронок) перепроверяет все сообщения.
+        """
         updated_count = 0
-        now = datetime.now(MOSCOW_TZ)
+        now_ts = datetime.now(MOSCOW_TZ).timestamp()
         FUNNELS = self.funnels_config.get_funnels()
         
-        for message_key, message in self.pending_messages.items():
-            timestamp = datetime.fromisoformat(message['timestamp'])
-            time_diff = now - timestamp
-            minutes_passed = int(time_diff.total_seconds() / 60)
+        if full or self.deadlines_config != tuple(sorted(FUNNELS.items())):
+            self.rebuild_funnel_deadlines()
+            if full:
+                for key in self.funnel_due:
+                    self.funnel_due[key] = 0
+                self.funnel_deadlines = [(0, key) for key in self.funnel_due]
+        
+        while self.funnel_deadlines and self.funnel_deadlines[0][0] <= now_ts:
+            due, message_key = heapq.heappop(self.funnel_deadlines)
+            # Пропускаем удаленные сообщения и устаревшие записи очереди
+            if self.funnel_due.get(message_key) != due:
+                continue
             
-            current_funnel = message.get('current_funnel', 0)
+            message = self.pending_messages[message_key]
+            minutes_passed = message.minutes_passed(now_ts)
+            current_funnel = message.current_funnel
             
             # Определяем текущую воронку на основе времени
-            new_funnel = 0
-            if minutes_passed >= FUNNELS[3]:
-                new_funnel = 3
-            elif minutes_passed >= FUNNELS[2]:
-                new_funnel = 2
-            elif minutes_passed >= FUNNELS[1]:
-                new_funnel = 1
+            new_funnel = funnel_for_minutes(minutes_passed, FUNNELS)
             
             # Обновляем если изменилась
             if new_funnel != current_funnel:
-                self.pending_messages[message_key]['current_funnel'] = new_funnel
+                self.set_message_funnel(message, new_funnel)
+                self.record_set(message_key)
                 updated_count += 1
                 logger.info(f"🔄 Сообщение {message_key}: воронка {current_funnel} -> {new_funnel} ({minutes_passed} минут)")
+            
+            next_crossing = self.next_funnel_crossing(message_key, now_ts)
+            if next_crossing is None:
+                del self.funnel_due[message_key]
+            else:
+                self.schedule_funnel_check(message_key, next_crossing)
         
         if updated_count > 0:
-            self.save_pending_messages()
             logger.info(f"✅ Обновлено статусов воронок: {updated_count} сообщений")
         
         return updated_count
     
-    def get_all_messages_older_than(self, minutes_threshold: int) -> List[Dict[str, Any]]:
+    def get_all_messages_older_than(self, minutes_threshold: int) -> List[PendingMessage]:
         result = []
-        now = datetime.now(MOSCOW_TZ)
+        now_ts = datetime.now(MOSCOW_TZ).timestamp()
         
-        for message_key, message in self.pending_messages.items():
-            timestamp = datetime.fromisoformat(message['timestamp'])
-            time_diff = now - timestamp
-            minutes_passed = int(time_diff.total_seconds() / 60)
-            
-            if minutes_passed >= minutes_threshold:
-                message['message_key'] = message_key
-                message['minutes_passed'] = minutes_passed
+        for message in self.pending_messages.values():
+            if message.minutes_passed(now_ts) >= minutes_threshold:
                 result.append(message)
         
         return result
@@ -539,19 +2196,31 @@ class PendingMessagesManager:
     def clear_all(self):
         count = len(self.pending_messages)
         self.pending_messages = {}
+        self.rebuild_indexes()
         self.save_pending_messages()
+        if self.change_listener:
+            self.change_listener('clear')
         logger.info(f"✅ Очищены все непрочитанные сообщения ({count} шт.)")
         return count
 
 # ========== ГЛОБАЛЬНЫЕ ЭКЗЕМПЛЯРЫ ==========
 
+state_load_started = perf_counter()
+state_writer = StateWriter()
+atexit.register(state_writer.stop)
+state_flusher = StateFlusher(STATE_FLUSH_INTERVAL)
+state_snapshot = StateSnapshot(STATE_SNAPSHOT_FILE, STATE_SNAPSHOT_ENABLED)
 funnels_config = FunnelsConfig()
 flags_manager = AutoReplyFlags()
 work_chat_manager = WorkChatManager()
+message_body_store = MessageBodyStore(MESSAGE_BODY_POLICY, MESSAGE_BODIES_DIR)
 pending_messages_manager = PendingMessagesManager(funnels_config)
 excluded_users_manager = ExcludedUsersManager()
 funnels_state_manager = FunnelsStateManager()
 master_notification_manager = MasterNotificationManager()
+transport_stats = TransportStats()
+business_calendar = BusinessCalendar()
+state_load_seconds = perf_counter() - state_load_started
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 
@@ -564,57 +2233,48 @@ def is_manager(user_id: int, username: str = None) -> bool:
 def is_excluded_user(user_id: int) -> bool:
     return excluded_users_manager.is_user_excluded(user_id)
 
+def is_manager_update(update: Update) -> bool:
+    """Является ли отправитель апдейта менеджером (проверяется один раз на апдейт)"""
+    user = update.message.from_user
+    return excluded_users_manager.is_update_sender_excluded(update.update_id, user.id, user.username)
+
 def is_working_hours():
-    now = datetime.now(MOSCOW_TZ)
-    current_time = now.time()
-    if current_time >= time(10, 0) and current_time <= time(19, 0):
-        return True
-    return False
+    return business_calendar.is_working_time()
 
-def should_respond_to_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    if not update or not update.message:
-        return False
-    
-    if update.message.from_user.id == context.bot.id:
-        return False
-        
-    if is_excluded_user(update.message.from_user.id):
-        return False
-        
-    if update.message.new_chat_members or update.message.left_chat_member:
-        return False
-        
-    if update.message.pinned_message:
-        return False
-        
-    if update.edited_message:
-        return False
-        
-    if update.message.text and update.message.text.startswith('/'):
-        return False
-        
-    if update.message.text and len(update.message.text.strip()) < 1:
-        return False
-        
-    return True
+def format_next_business_boundary() -> str:
+    """Когда закончится/начнется рабочее время, для отчетов"""
+    boundary = business_calendar.next_boundary()
+    if boundary == float('inf'):
+        return "рабочих окон нет"
+    when = datetime.fromtimestamp(boundary, MOSCOW_TZ).strftime('%d.%m %H:%M')
+    return f"до {when}" if business_calendar.is_working_time() else f"начнутся {when}"
 
-def get_chat_display_name(chat_data: Dict[str, Any]) -> str:
-    chat_title = chat_data.get('chat_title')
-    if chat_title:
-        return chat_title
+def format_startup_report() -> str:
+    """Время загрузки состояния при запуске и откуда загружены разделы"""
+    from_snapshot = sorted(name for name, source in state_snapshot.sources.items() if source == 'snapshot')
+    from_json = sorted(name for name, source in state_snapshot.sources.items() if source == 'json')
+    text = f"⏱️ Состояние загружено за {state_load_seconds * 1000:.0f} мс"
+    if not state_snapshot.enabled:
+        return text + " (бинарный снимок выключен)"
+    text += f" (чтение снимка {state_snapshot.load_seconds * 1000:.0f} мс)"
+    if from_snapshot:
+        text += f"\n   из снимка: {', '.join(from_snapshot)}"
+    if from_json:
+        text += f"\n   из JSON: {', '.join(from_json)}"
+    return text
+
+def get_chat_display_name(chat_info: ChatAggregate) -> str:
+    if chat_info.chat_title:
+        return chat_info.chat_title
     else:
-        return f"Чат {chat_data['chat_id']}"
+        return f"Чат {chat_info.chat_id}"
 
 def get_funnel_emoji(funnel_number: int) -> str:
     emojis = {1: "🟡", 2: "🟠", 3: "🔴"}
     return emojis.get(funnel_number, "⚪")
 
-def format_time_ago(timestamp: str) -> str:
-    message_time = datetime.fromisoformat(timestamp)
-    now = datetime.now(MOSCOW_TZ)
-    time_diff = now - message_time
-    
-    total_minutes = int(time_diff.total_seconds() / 60)
+def format_time_ago(timestamp: float) -> str:
+    total_minutes = int((datetime.now(MOSCOW_TZ).timestamp() - timestamp) / 60)
     hours = total_minutes // 60
     minutes = total_minutes % 60
     
@@ -645,29 +2305,33 @@ async def update_message_funnel_statuses():
 
 def create_master_notification_text() -> str:
     """Создает текст единого уведомления со всеми воронками (без дублирования чатов)"""
+    return create_master_notification_body() + format_notification_footer()
+
+def format_notification_footer() -> str:
+    return f"\n⏰ Обновлено: {datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')}"
+
+def master_notification_digest(chats_data: Dict[int, ChatAggregate]) -> str:
+    """SHA-256 содержимого уведомления без относительного времени ("N назад").
+    
+    Меняется, только если изменились чаты, их воронки, число сообщений, время самого
+    старого сообщения или пороги воронок; хранится только хэш, а не сам список чатов.
+    """
+    FUNNELS = funnels_config.get_funnels()
+    chats = [
+        (chat_id, get_chat_display_name(chat_data), chat_data.current_funnel,
+         chat_data.message_count, chat_data.oldest_time)
+        for chat_id, chat_data in chats_data.items()
+    ]
+    content = json.dumps([FUNNELS[1], FUNNELS[2], FUNNELS[3], pending_messages_manager.count_messages(), chats])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def create_master_notification_body(chats_data: Dict[int, ChatAggregate] = None) -> str:
+    """Текст единого уведомления без строки времени обновления"""
     FUNNELS = funnels_config.get_funnels()
     
-    # Собираем ВСЕ сообщения и группируем по чатам
-    all_messages = pending_messages_manager.get_all_pending_messages()
-    chats_data = {}
-    
-    for msg in all_messages:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {
-                'chat_info': msg,
-                'message_count': 0,
-                'oldest_time': msg['timestamp'],
-                'current_funnel': 0
-            }
-        chats_data[chat_id]['message_count'] += 1
-        if msg['timestamp'] < chats_data[chat_id]['oldest_time']:
-            chats_data[chat_id]['oldest_time'] = msg['timestamp']
-        
-        # Определяем максимальную воронку для чата
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
+    # Сводки по чатам поддерживаются менеджером при каждом изменении сообщений
+    if chats_data is None:
+        chats_data = pending_messages_manager.get_chat_aggregates()
     
     # Распределяем чаты по воронкам
     funnel_1_chats = {}
@@ -675,7 +2339,7 @@ def create_master_notification_text() -> str:
     funnel_3_chats = {}
     
     for chat_id, chat_data in chats_data.items():
-        funnel = chat_data['current_funnel']
+        funnel = chat_data.current_funnel
         if funnel == 1:
             funnel_1_chats[chat_id] = chat_data
         elif funnel == 2:
@@ -690,9 +2354,9 @@ def create_master_notification_text() -> str:
     notification_text += f"🟡 {minutes_to_hours_text(FUNNELS[1])} без ответа\n"
     if funnel_1_chats:
         for chat_id, chat_data in funnel_1_chats.items():
-            chat_display = get_chat_display_name(chat_data['chat_info'])
-            message_count = chat_data['message_count']
-            time_ago = format_time_ago(chat_data['oldest_time'])
+            chat_display = get_chat_display_name(chat_data)
+            message_count = chat_data.message_count
+            time_ago = format_time_ago(chat_data.oldest_time)
             notification_text += f"  • {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
     else:
         notification_text += "  Таких нет\n"
@@ -702,9 +2366,9 @@ def create_master_notification_text() -> str:
     notification_text += f"🟠 {minutes_to_hours_text(FUNNELS[2])} без ответа\n"
     if funnel_2_chats:
         for chat_id, chat_data in funnel_2_chats.items():
-            chat_display = get_chat_display_name(chat_data['chat_info'])
-            message_count = chat_data['message_count']
-            time_ago = format_time_ago(chat_data['oldest_time'])
+            chat_display = get_chat_display_name(chat_data)
+            message_count = chat_data.message_count
+            time_ago = format_time_ago(chat_data.oldest_time)
             notification_text += f"  • {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
     else:
         notification_text += "  Таких нет\n"
@@ -714,47 +2378,109 @@ def create_master_notification_text() -> str:
     notification_text += f"🔴 БОЛЕЕ {minutes_to_hours_text(FUNNELS[3])} без ответа\n"
     if funnel_3_chats:
         for chat_id, chat_data in funnel_3_chats.items():
-            chat_display = get_chat_display_name(chat_data['chat_info'])
-            message_count = chat_data['message_count']
-            time_ago = format_time_ago(chat_data['oldest_time'])
+            chat_display = get_chat_display_name(chat_data)
+            message_count = chat_data.message_count
+            time_ago = format_time_ago(chat_data.oldest_time)
             notification_text += f"  • {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
     else:
         notification_text += "  Таких нет\n"
     
     # Добавляем общую статистику
-    total_messages = len(all_messages)
+    total_messages = pending_messages_manager.count_messages()
     total_chats = len(chats_data)
     
     notification_text += f"\n📈 **ИТОГО:** {total_messages} сообщений в {total_chats} чатах"
-    notification_text += f"\n⏰ Обновлено: {datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')}"
     
     return notification_text
 
-async def delete_old_notifications(context: ContextTypes.DEFAULT_TYPE):
-    """Удаляет старые уведомления"""
-    work_chat_id = work_chat_manager.get_work_chat_id()
-    if not work_chat_id:
-        return
+async def delete_notification_messages(context: ContextTypes.DEFAULT_TYPE, work_chat_id: int, message_ids: List[int]) -> List[int]:
+    """Удаляет сообщения параллельно (не больше NOTIFICATION_DELETE_CONCURRENCY одновременно).
     
-    try:
-        message_ids = master_notification_manager.get_message_ids()
-        for message_id in message_ids:
+    Возвращает ID, которые больше не нужно удалять: удаленные и те, что Telegram
+    отклонил окончательно (уже удалены или слишком старые). Сообщения с временными
+    ошибками (сеть, таймаут, flood control) остаются для повторной попытки.
+    """
+    semaphore = asyncio.Semaphore(max(1, NOTIFICATION_DELETE_CONCURRENCY))
+    
+    async def delete_one(message_id: int) -> bool:
+        async with semaphore:
             try:
                 await context.bot.delete_message(
                     chat_id=work_chat_id,
-                    message_id=message_id
+                    message_id=message_id,
+                    rate_limit_args={'priority': PRIORITY_BULK}
                 )
                 logger.info(f"✅ Удалено старое уведомление: {message_id}")
-            except Exception as e:
+                return True
+            except BadRequest as e:
                 logger.warning(f"❌ Не удалось удалить сообщение {message_id}: {e}")
+                return True
+            except Exception as e:
+                logger.warning(f"❌ Не удалось удалить сообщение {message_id}, повторим позже: {e}")
+                return False
+    
+    results = await asyncio.gather(*(delete_one(message_id) for message_id in message_ids))
+    return [message_id for message_id, done in zip(message_ids, results) if done]
+
+async def delete_old_notifications(context: ContextTypes.DEFAULT_TYPE, keep_last: bool = False):
+    """Удаляет старые уведомления (keep_last=True - кроме последнего, текущего)"""
+    work_chat_id = work_chat_manager.get_work_chat_id()
+    if not work_chat_id:
+        return
+    
+    try:
+        message_ids = list(master_notification_manager.get_message_ids())
+        if keep_last:
+            message_ids = message_ids[:-1]
+        if not message_ids:
+            return
+        
+        done_ids = await delete_notification_messages(context, work_chat_id, message_ids)
         
-        # Очищаем список сообщений после удаления
-        master_notification_manager.data["message_ids"] = []
-        master_notification_manager.save_data()
+        # Убираем из списка удаленные сообщения; неудавшиеся останутся для повторной попытки
+        master_notification_manager.remove_message_ids(done_ids)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при удалении старых уведомлений: {e}")
+        logger.error(f"❌ Ошибка при удалении старых уведомлений: {e}")
+
+async def edit_master_notification(context: ContextTypes.DEFAULT_TYPE, work_chat_id: int, chats_data: Dict[int, ChatAggregate],
+                                   digest: str, skip_unchanged: bool) -> bool:
+    """Обновляет текущее уведомление на месте.
+    
+    При skip_unchanged, если содержимое (без относительного времени) не изменилось, запрос
+    к Bot API не выполняется. Возвращает False, если редактировать нечего или редактирование
+    не удалось - тогда уведомление пересоздается.
+    """
+    message_ids = master_notification_manager.get_message_ids()
+    if not message_ids:
+        return False
+    
+    if skip_unchanged and digest == master_notification_manager.get_last_digest():
+        logger.info("ℹ️ Содержимое уведомления не изменилось, обновление пропущено")
+        return True
+    
+    body = create_master_notification_body(chats_data)
+    try:
+        await context.bot.edit_message_text(
+            chat_id=work_chat_id,
+            message_id=message_ids[-1],
+            text=body + format_notification_footer(),
+            parse_mode='Markdown',
+            rate_limit_args={'priority': PRIORITY_NOTIFICATION}
+        )
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            logger.warning(f"⚠️ Не удалось отредактировать уведомление {message_ids[-1]}: {e}")
+            return False
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось отредактировать уведомление {message_ids[-1]}: {e}")
+        return False
+    
+    master_notification_manager.set_last_digest(digest)
+    logger.info(f"✏️ Уведомление {message_ids[-1]} отредактировано")
+    return True
 
+@observe_latency('send_new_master_notification')
 async def send_new_master_notification(context: ContextTypes.DEFAULT_TYPE, force: bool = False):
     """Отправляет новое уведомление (удаляет старые и отправляет новое)"""
     work_chat_id = work_chat_manager.get_work_chat_id()
@@ -768,20 +2494,35 @@ async def send_new_master_notification(context: ContextTypes.DEFAULT_TYPE, force
         return False
     
     try:
+        chats_data = pending_messages_manager.get_chat_aggregates()
+        digest = master_notification_digest(chats_data) if NOTIFICATION_EDIT_MODE else None
+        
+        # В режиме редактирования сначала пробуем обновить текущее уведомление на месте.
+        # Форсированные обновления (по событиям) пропускаются, если содержимое не изменилось;
+        # плановое обновление редактирует всегда, чтобы обновить "N назад" и время обновления
+        if NOTIFICATION_EDIT_MODE and await edit_master_notification(context, work_chat_id, chats_data, digest, skip_unchanged=force):
+            master_notification_manager.update_notification_time()
+            # Повторяем удаление уведомлений, которые не удалось удалить раньше
+            await delete_old_notifications(context, keep_last=True)
+            return True
+        
         # Сначала удаляем старые уведомления
         await delete_old_notifications(context)
         
         # Затем отправляем новое
-        notification_text = create_master_notification_text()
+        notification_text = create_master_notification_body(chats_data) + format_notification_footer()
         
         sent_message = await context.bot.send_message(
             chat_id=work_chat_id,
             text=notification_text,
-            parse_mode='Markdown'
+            parse_mode='Markdown',
+            rate_limit_args={'priority': PRIORITY_NOTIFICATION}
         )
         
         # Сохраняем ID нового сообщения
         master_notification_manager.add_message_id(sent_message.message_id)
+        if NOTIFICATION_EDIT_MODE:
+            master_notification_manager.set_last_digest(digest)
         
         # УБРАНА АВТОМАТИЧЕСКАЯ ПОМЕТКА СООБЩЕНИЙ КАК ОБРАБОТАННЫХ
         # Сообщения будут продолжать показываться пока на них не ответят
@@ -789,8 +2530,8 @@ async def send_new_master_notification(context: ContextTypes.DEFAULT_TYPE, force
         # Обновляем время последней отправки
         master_notification_manager.update_notification_time()
         
-        # Очищаем старые сообщения (оставляем только последние 3)
-        master_notification_manager.clear_old_messages(keep_last=3)
+        # Список не обрезается: в нем остались только новое уведомление и те,
+        # что не удалось удалить из-за временной ошибки, - они удалятся при следующем обновлении
         
         logger.info("✅ Отправлено новое единое уведомление")
         return True
@@ -799,6 +2540,7 @@ async def send_new_master_notification(context: ContextTypes.DEFAULT_TYPE, force
         logger.error(f"❌ Ошибка отправки нового уведомления: {e}")
         return False
 
+@observe_latency('check_and_send_new_notification')
 async def check_and_send_new_notification(context: ContextTypes.DEFAULT_TYPE):
     """Проверяет и отправляет новое уведомление каждые 30 минут с автоматическим обновлением статусов"""
     logger.info("🔄 Проверка необходимости отправки уведомления...")
@@ -811,15 +2553,102 @@ async def check_and_send_new_notification(context: ContextTypes.DEFAULT_TYPE):
     # ПОТОМ ОТПРАВЛЯЕМ УВЕДОМЛЕНИЕ
     await send_new_master_notification(context)
 
+class NotificationRefreshDebouncer:
+    """Объединяет серию форсированных обновлений уведомления в одно.
+    
+    Каждый новый запрос переносит обновление на debounce секунд вперед, но не дальше
+    max_delay секунд от первого запроса серии.
+    """
+    
+    def __init__(self, debounce: float, max_delay: float):
+        self.debounce = debounce
+        self.max_delay = max(debounce, max_delay)
+        self.job = None
+        self.first_request = None
+    
+    def request(self, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Планирует обновление; False - отложить нельзя и обновлять нужно сразу"""
+        job_queue = context.job_queue
+        if self.debounce <= 0 or not job_queue:
+            return False
+        
+        now = asyncio.get_running_loop().time()
+        if self.job is None:
+            self.first_request = now
+        else:
+            self.job.schedule_removal()
+        
+        remaining = self.max_delay - (now - self.first_request)
+        when = max(0.0, min(self.debounce, remaining))
+        self.job = job_queue.run_once(self.run, when=when, name="notification_refresh")
+        return True
+    
+    async def run(self, context: ContextTypes.DEFAULT_TYPE):
+        self.job = None
+        self.first_request = None
+        logger.info("🔄 Отложенное обновление уведомления после ответов менеджеров")
+        await send_new_master_notification(context, force=True)
+
+notification_refresher = NotificationRefreshDebouncer(NOTIFICATION_REFRESH_DEBOUNCE, NOTIFICATION_REFRESH_MAX_DELAY)
+
+async def request_notification_refresh(context: ContextTypes.DEFAULT_TYPE):
+    """Форсированно обновляет уведомление, объединяя частые запросы"""
+    if shard_link:
+        # Уведомлением управляет процесс-приемник
+        shard_link.send('refresh')
+        return
+    if not notification_refresher.request(context):
+        await send_new_master_notification(context, force=True)
+
+# ========== СОХРАНЕНИЕ СОСТОЯНИЯ ==========
+
+async def flush_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически записывает накопленные изменения состояния на диск"""
+    state_flusher.flush()
+
+async def compact_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически удаляет устаревшие флаги автоответов и отметки воронок"""
+    expired_flags = flags_manager.expire()
+    expired_marks = funnels_state_manager.expire()
+    if expired_flags or expired_marks:
+        logger.info(f"🧹 Удалено устаревших флагов: {expired_flags}, отметок воронок: {expired_marks}")
+
+def save_state_snapshot():
+    try:
+        state_snapshot.save()
+    except Exception as e:
+        logger.error(f"Ошибка записи снимка состояния: {e}")
+
+async def snapshot_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически обновляет бинарный снимок состояния"""
+    state_flusher.flush()
+    save_state_snapshot()
+
+async def message_bodies_gc_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически удаляет файлы текстов уже обработанных сообщений"""
+    removed = pending_messages_manager.collect_message_bodies()
+    if removed:
+        logger.info(f"🧹 Удалено файлов текстов сообщений: {removed}")
+
+async def on_shutdown(application: Application):
+    """Записывает все несохраненные изменения при остановке бота"""
+    if shard_coordinator:
+        await shard_coordinator.stop()
+    await stop_metrics_server()
+    flushed = state_flusher.flush()
+    save_state_snapshot()
+    await asyncio.to_thread(state_writer.wait)
+    logger.info(f"💾 Сохранено файлов состояния при остановке: {flushed}")
+
 # ========== ОБРАБОТЧИК ОТВЕТОВ МЕНЕДЖЕРА ==========
 
+@observe_latency('handle_manager_reply')
 async def handle_manager_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает ответы менеджеров и обновляет уведомление"""
     if not update or not update.message:
         return
         
-    username = update.message.from_user.username
-    if not is_manager(update.message.from_user.id, username):
+    if not is_manager_update(update):
         return
         
     if update.message.text and update.message.text.startswith('/'):
@@ -834,8 +2663,8 @@ async def handle_manager_reply(update: Update, context: ContextTypes.DEFAULT_TYP
     if removed_count > 0:
         logger.info(f"✅ Удалено {removed_count} сообщений из чата {chat_id} после ответа менеджера")
         
-        # Немедленно отправляем новое уведомление (форсированно)
-        await send_new_master_notification(context, force=True)
+        # Обновляем уведомление (форсированно); серия ответов подряд дает одно обновление
+        await request_notification_refresh(context)
 
 # ========== КОМАНДЫ БОТА ==========
 
@@ -902,8 +2731,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **Обновление уведомления:**
 /update_notification - обновить единое уведомление
 
+**Рабочее время:**
+/reload_calendar - перечитать business_calendar.json
+
 **Статистика:**
 /stats - статистика системы
+/transport - задержки и ошибки запросов к Telegram (/transport reset - сбросить)
+/perf - время выполнения обработчиков (/perf reset - сбросить)
 /managers - список менеджеров
 
 📝 **Логика работы воронок:**
@@ -928,21 +2762,10 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
     
     # Получаем статистику по воронкам (без дублирования)
-    all_messages = pending_messages_manager.get_all_pending_messages()
-    chats_data = {}
-    
-    for msg in all_messages:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {'current_funnel': 0}
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    funnel_1_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 1)
-    funnel_2_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 2)
-    funnel_3_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 3)
+    funnel_counts = pending_messages_manager.count_chats_by_funnel()
+    funnel_1_count = funnel_counts[1]
+    funnel_2_count = funnel_counts[2]
+    funnel_3_count = funnel_counts[3]
     
     # Время последнего уведомления
     last_notification = master_notification_manager.last_notification_time
@@ -952,9 +2775,9 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 **СТАТУС СИСТЕМЫ**
 
 ⏰ **Время:** {now.strftime('%d.%m.%Y %H:%M:%S')}
-🕐 **Рабочие часы:** {'✅ ДА' if is_working_hours() else '❌ НЕТ'}
+🕐 **Рабочие часы:** {'✅ ДА' if is_working_hours() else '❌ НЕТ'} ({format_next_business_boundary()})
 
-📋 **Непрочитанные сообщения:** {len(all_messages)}
+📋 **Непрочитанные сообщения:** {pending_messages_manager.count_messages()}
 🚩 **Флаги автоответов:** {flags_manager.count_flags()}
 💬 **Рабочий чат:** {'✅ Установлен' if work_chat_manager.is_work_chat_set() else '❌ Не установлен'}
 📢 **Последнее уведомление:** {last_notification_str}
@@ -1122,55 +2945,37 @@ async def debug_funnels_command(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
         return
     
-    # Получаем все сообщения и группируем по чатам
-    all_messages = pending_messages_manager.get_all_pending_messages()
-    chats_data = {}
-    
-    for msg in all_messages:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {
-                'chat_info': msg,
-                'messages': [],
-                'current_funnel': 0
-            }
-        chats_data[chat_id]['messages'].append(msg)
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
+    # Сводки по чатам
+    chats_data = pending_messages_manager.get_chat_aggregates()
     
     debug_text = "🐛 **ОТЛАДКА ВОРОНОК**\n\n"
     
     FUNNELS = funnels_config.get_funnels()
     
     # Показываем чаты по воронкам
-    funnel_1_chats = {chat_id: data for chat_id, data in chats_data.items() if data['current_funnel'] == 1}
-    funnel_2_chats = {chat_id: data for chat_id, data in chats_data.items() if data['current_funnel'] == 2}
-    funnel_3_chats = {chat_id: data for chat_id, data in chats_data.items() if data['current_funnel'] == 3}
+    funnel_1_chats = {chat_id: data for chat_id, data in chats_data.items() if data.current_funnel == 1}
+    funnel_2_chats = {chat_id: data for chat_id, data in chats_data.items() if data.current_funnel == 2}
+    funnel_3_chats = {chat_id: data for chat_id, data in chats_data.items() if data.current_funnel == 3}
     
     debug_text += f"🟡 Воронка 1 ({FUNNELS[1]} мин): {len(funnel_1_chats)} чатов\n"
     for chat_id, chat_data in funnel_1_chats.items():
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest_time = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest_time)
+        chat_display = get_chat_display_name(chat_data)
+        message_count = chat_data.message_count
+        time_ago = format_time_ago(chat_data.oldest_time)
         debug_text += f"   - {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
     
     debug_text += f"\n🟠 Воронка 2 ({FUNNELS[2]} мин): {len(funnel_2_chats)} чатов\n"
     for chat_id, chat_data in funnel_2_chats.items():
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest_time = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest_time)
+        chat_display = get_chat_display_name(chat_data)
+        message_count = chat_data.message_count
+        time_ago = format_time_ago(chat_data.oldest_time)
         debug_text += f"   - {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
     
     debug_text += f"\n🔴 Воронка 3 ({FUNNELS[3]} мин): {len(funnel_3_chats)} чатов\n"
     for chat_id, chat_data in funnel_3_chats.items():
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest_time = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest_time)
+        chat_display = get_chat_display_name(chat_data)
+        message_count = chat_data.message_count
+        time_ago = format_time_ago(chat_data.oldest_time)
         debug_text += f"   - {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
     
     await update.message.reply_text(debug_text, parse_mode='Markdown')
@@ -1186,39 +2991,10 @@ async def fix_funnel_statuses_command(update: Update, context: ContextTypes.DEFA
     
     await update.message.reply_text("🔧 Исправляю статусы воронок...")
     
-    all_pending = pending_messages_manager.get_all_pending_messages()
-    fixed_count = 0
-    
-    for message in all_pending:
-        message_key = message.get('message_key')
-        if not message_key:
-            continue
-            
-        timestamp = datetime.fromisoformat(message['timestamp'])
-        now = datetime.now(MOSCOW_TZ)
-        time_diff = now - timestamp
-        minutes_passed = int(time_diff.total_seconds() / 60)
-        
-        FUNNELS = funnels_config.get_funnels()
-        current_funnel = message.get('current_funnel', 0)
-        
-        # Определяем правильную воронку на основе времени
-        correct_funnel = 0
-        if minutes_passed >= FUNNELS[3]:
-            correct_funnel = 3
-        elif minutes_passed >= FUNNELS[2]:
-            correct_funnel = 2
-        elif minutes_passed >= FUNNELS[1]:
-            correct_funnel = 1
-        
-        # Исправляем если необходимо
-        if correct_funnel != current_funnel:
-            pending_messages_manager.pending_messages[message_key]['current_funnel'] = correct_funnel
-            fixed_count += 1
-            logger.info(f"🔧 Исправлена воронка для {message_key}: {current_funnel} -> {correct_funnel}")
+    # Полная перепроверка всех сообщений, а не только тех, у кого наступил порог воронки
+    fixed_count = pending_messages_manager.update_funnel_statuses(full=True)
     
     if fixed_count > 0:
-        pending_messages_manager.save_pending_messages()
         await update.message.reply_text(f"✅ Исправлено статусов воронок: {fixed_count} сообщений")
         # Сразу отправляем обновленное уведомление
         await send_new_master_notification(context, force=True)
@@ -1297,41 +3073,30 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
         return
     
-    all_pending = pending_messages_manager.get_all_pending_messages()
+    total_pending = pending_messages_manager.count_messages()
     excluded_users = excluded_users_manager.get_all_excluded()
     total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
     
-    # Группируем по чатам для статистики воронок
-    chats_data = {}
-    for msg in all_pending:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {'current_funnel': 0}
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    funnel_1_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 1)
-    funnel_2_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 2)
-    funnel_3_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 3)
+    # Статистика воронок по сводкам чатов
+    chats_data = pending_messages_manager.get_chat_aggregates()
+    funnel_counts = pending_messages_manager.count_chats_by_funnel()
+    funnel_1_count = funnel_counts[1]
+    funnel_2_count = funnel_counts[2]
+    funnel_3_count = funnel_counts[3]
     
     now = datetime.now(MOSCOW_TZ)
-    time_stats = {"менее 1 часа": 0, "1-3 часа": 0, "3-6 часов": 0, "более 6 часов": 0}
-    
-    for message in all_pending:
-        timestamp = datetime.fromisoformat(message['timestamp'])
-        time_diff = now - timestamp
-        hours_passed = time_diff.total_seconds() / 3600
-        
-        if hours_passed < 1:
-            time_stats["менее 1 часа"] += 1
-        elif hours_passed < 3:
-            time_stats["1-3 часа"] += 1
-        elif hours_passed < 6:
-            time_stats["3-6 часов"] += 1
-        else:
-            time_stats["более 6 часов"] += 1
+    
+    # Распределение по времени ожидания - бинарным поиском по отсортированным временам сообщений
+    now_ts = now.timestamp()
+    older_1h = pending_messages_manager.count_messages_older_than(3600, now_ts)
+    older_3h = pending_messages_manager.count_messages_older_than(3 * 3600, now_ts)
+    older_6h = pending_messages_manager.count_messages_older_than(6 * 3600, now_ts)
+    time_stats = {
+        "менее 1 часа": total_pending - older_1h,
+        "1-3 часа": older_1h - older_3h,
+        "3-6 часов": older_3h - older_6h,
+        "более 6 часов": older_6h
+    }
     
     # Время последнего уведомления
     last_notification = master_notification_manager.last_notification_time
@@ -1341,7 +3106,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📈 **СТАТИСТИКА СИСТЕМЫ**
 
 📊 **Общая статистика:**
-   - Непрочитанных сообщений: {len(all_pending)}
+   - Непрочитанных сообщений: {total_pending}
    - Чатов с сообщениями: {len(chats_data)}
    - Флагов автоответов: {flags_manager.count_flags()}
    - Менеджеров в системе: {total_excluded} ({len(excluded_users["user_ids"])} ID + {len(excluded_users["usernames"])} username)
@@ -1367,6 +3132,94 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(stats_text, parse_mode='Markdown')
 
+async def transport_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает задержки и ошибки запросов к Bot API по методам"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if context.args and context.args[0].lower() == 'reset':
+        transport_stats.reset()
+        await update.message.reply_text("✅ Счетчики транспорта сброшены")
+        return
+    
+    if not transport_stats.endpoints:
+        await update.message.reply_text("📡 Запросов к Telegram еще не было")
+        return
+    
+    text = "📡 **ЗАПРОСЫ К TELEGRAM BOT API**\n\n"
+    for endpoint, stats in sorted(transport_stats.endpoints.items(), key=lambda item: -item[1].requests):
+        average_ms = stats.total_seconds / stats.requests * 1000
+        text += f"**{endpoint}**: {stats.requests} запр., ошибок {stats.errors}, "
+        text += f"сред. {average_ms:.0f} мс, макс. {stats.max_seconds * 1000:.0f} мс\n"
+        failed_codes = {code: count for code, count in stats.status_codes.items() if code >= 400}
+        if failed_codes:
+            codes_text = ", ".join(f"{code}: {count}" for code, count in sorted(failed_codes.items()))
+            text += f"   коды ошибок: {codes_text}\n"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def reload_calendar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перечитывает рабочий календарь без перезапуска бота"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    try:
+        business_calendar.reload()
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка в {BUSINESS_CALENDAR_FILE}: {e}")
+        return
+    
+    day_names = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+    lines = []
+    for day in range(7):
+        windows = business_calendar.weekdays[day]
+        windows_text = ", ".join(f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}" for start, end in windows)
+        lines.append(f"{day_names[day]}: {windows_text or 'выходной'}")
+    
+    await update.message.reply_text(
+        "✅ Рабочий календарь перечитан\n\n" + "\n".join(lines) +
+        f"\n\nПраздников: {len(business_calendar.holidays)}\n"
+        f"Сейчас: {'рабочее время' if is_working_hours() else 'нерабочее время'} ({format_next_business_boundary()})"
+    )
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает время выполнения обработчиков и задач (p50/p95/p99/max)"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if context.args and context.args[0].lower() == 'reset':
+        perf_stats.reset()
+        await update.message.reply_text("✅ Замеры времени обработчиков сброшены")
+        return
+    
+    if not perf_stats.reservoirs:
+        await update.message.reply_text("⏱️ Замеров еще нет")
+        return
+    
+    rows = []
+    for name, reservoir in perf_stats.reservoirs.items():
+        p50, p95, p99 = reservoir.percentiles(0.5, 0.95, 0.99)
+        rows.append((p99, name, reservoir, p50, p95))
+    
+    text = f"⏱️ **ВРЕМЯ ОБРАБОТЧИКОВ** (последние {perf_stats.reservoir_size} вызовов, мс)\n\n"
+    for p99, name, reservoir, p50, p95 in sorted(rows, key=lambda row: -row[0]):
+        text += f"`{name}`: {reservoir.calls} выз.\n"
+        text += f"   p50 {p50 * 1000:.1f} | p95 {p95 * 1000:.1f} | p99 {p99 * 1000:.1f} | макс. {reservoir.max_seconds * 1000:.1f}\n"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
 async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update or not update.message:
         return
@@ -1375,37 +3228,23 @@ async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
         return
     
-    all_pending = pending_messages_manager.get_all_pending_messages()
+    total_pending = pending_messages_manager.count_messages()
     
-    if not all_pending:
+    if not total_pending:
         await update.message.reply_text("✅ Нет непрочитанных сообщений")
         return
     
-    # Группируем по чатам
-    chats_data = {}
-    for msg in all_pending:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {
-                'chat_info': msg,
-                'messages': [],
-                'current_funnel': 0
-            }
-        chats_data[chat_id]['messages'].append(msg)
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
+    # Сводки по чатам
+    chats_data = pending_messages_manager.get_chat_aggregates()
     
-    pending_text = f"📋 **НЕПРОЧИТАННЫЕ СООБЩЕНИЯ**\n\nВсего сообщений: {len(all_pending)}\nЧатов: {len(chats_data)}\n\n"
+    pending_text = f"📋 **НЕПРОЧИТАННЫЕ СООБЩЕНИЯ**\n\nВсего сообщений: {total_pending}\nЧатов: {len(chats_data)}\n\n"
     
     for i, (chat_id, chat_data) in enumerate(chats_data.items(), 1):
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest)
+        chat_display = get_chat_display_name(chat_data)
+        message_count = chat_data.message_count
+        time_ago = format_time_ago(chat_data.oldest_time)
         
-        current_funnel = chat_data['current_funnel']
+        current_funnel = chat_data.current_funnel
         funnel_emoji = get_funnel_emoji(current_funnel) if current_funnel > 0 else "⚪"
         
         pending_text += f"{i}. {chat_display} {funnel_emoji}\n"
@@ -1545,82 +3384,184 @@ async def clear_exceptions_command(update: Update, context: ContextTypes.DEFAULT
 
 # ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
 
-async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    logger.info(f"📨 Получено групповое сообщение: {update.message.chat.title} - {update.message.text[:50] if update.message.text else '[медиа]'}...")
+@observe_latency('send_auto_reply')
+async def send_auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет автоответ с наивысшим приоритетом в очереди исходящих запросов"""
+    chat = update.message.chat
+    await context.bot.send_message(
+        chat_id=chat.id,
+        text=AUTO_REPLY_MESSAGE,
+        reply_to_message_id=update.message.message_id if chat.type != 'private' else None,
+        rate_limit_args={'priority': PRIORITY_AUTO_REPLY}
+    )
+
+# Фильтры маршрутизатора создаются один раз при загрузке модуля
+ROUTED_MESSAGES = filters.UpdateType.MESSAGE & (filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL)
+GROUP_CHATS = filters.ChatType.GROUPS
+PRIVATE_CHATS = filters.ChatType.PRIVATE
+SERVICE_MESSAGES = (
+    filters.StatusUpdate.NEW_CHAT_MEMBERS
+    | filters.StatusUpdate.LEFT_CHAT_MEMBER
+    | filters.StatusUpdate.PINNED_MESSAGE
+)
+
+# Тип чата
+CHAT_GROUP = 'group'
+CHAT_PRIVATE = 'private'
+CHAT_OTHER = 'other'
+
+# Роль отправителя
+SENDER_BOT = 'bot'
+SENDER_MANAGER = 'manager'
+SENDER_CLIENT = 'client'
+
+# Вид сообщения
+KIND_CONTENT = 'content'
+KIND_SERVICE = 'service'
+KIND_COMMAND = 'command'
+KIND_EMPTY = 'empty'
+
+def classify_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Определяет тип чата, роль отправителя и вид сообщения за один проход"""
+    message = update.message
+    
+    if GROUP_CHATS.check_update(update):
+        chat_kind = CHAT_GROUP
+    elif PRIVATE_CHATS.check_update(update):
+        chat_kind = CHAT_PRIVATE
+    else:
+        chat_kind = CHAT_OTHER
     
-    username = update.message.from_user.username
-    if is_manager(update.message.from_user.id, username):
-        await handle_manager_reply(update, context)
-        return
+    if message.from_user.id == context.bot.id:
+        sender = SENDER_BOT
+    elif is_manager_update(update):
+        sender = SENDER_MANAGER
+    else:
+        sender = SENDER_CLIENT
+    
+    text = message.text
+    if SERVICE_MESSAGES.check_update(update):
+        kind = KIND_SERVICE
+    elif text and text.startswith('/'):
+        kind = KIND_COMMAND
+    elif text is not None and not text.strip():
+        kind = KIND_EMPTY
+    else:
+        kind = KIND_CONTENT
     
-    if not should_respond_to_message(update, context):
-        logger.info("❌ Сообщение не требует обработки")
-        return
+    return chat_kind, sender, kind
+
+class ChatLocks:
+    """Очередность обработки по chat_id.
     
-    if update.message.chat.type in ['group', 'supergroup']:
-        chat_id = update.message.chat.id
-        replied_key = f'chat_{chat_id}'
-        
-        if not is_working_hours():
-            # Проверяем, не отправляли ли уже автоответ в этот чат
-            if not flags_manager.has_replied(replied_key):
-                await update.message.reply_text(AUTO_REPLY_MESSAGE)
-                flags_manager.set_replied(replied_key)
-                logger.info(f"✅ Автоответ отправлен в чат {chat_id}")
-            else:
-                logger.info(f"ℹ️ Автоответ уже был отправлен в чат {chat_id}, пропускаем")
-        else:
-            # В рабочее время сбрасываем флаг автоответа для этого чата
-            if flags_manager.has_replied(replied_key):
-                flags_manager.clear_replied(replied_key)
-                logger.info(f"🔄 Флаг автоответа сброшен для чата {chat_id} (рабочее время)")
-            
-            # Добавляем сообщение в непрочитанные только если оно от клиента (не менеджера)
-            if not is_manager(update.message.from_user.id, username):
-                chat_title = update.message.chat.title
-                username = update.message.from_user.username
-                first_name = update.message.from_user.first_name
-                message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
-                
-                pending_messages_manager.add_message(
-                    chat_id=update.message.chat.id,
-                    user_id=update.message.from_user.id,
-                    message_text=message_text,
-                    message_id=update.message.message_id,
-                    chat_title=chat_title,
-                    username=username,
-                    first_name=first_name
-                )
-                logger.info(f"✅ Добавлено в непрочитанные: чат '{chat_title}', пользователь {update.message.from_user.id}")
-                
-                # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
-                logger.info("📝 Новое сообщение добавлено, уведомление будет отправлено по расписанию")
+    При UPDATE_WORKERS > 1 апдейты разных чатов обрабатываются параллельно, а апдейты
+    одного чата ждут друг друга: asyncio.Lock пропускает ожидающих в порядке прихода.
+    Блокировка удаляется, когда ее больше никто не держит и не ждет.
+    """
+    
+    def __init__(self):
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.users: Dict[int, int] = {}
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, chat_id: int):
+        lock = self.locks.get(chat_id)
+        if lock is None:
+            lock = self.locks[chat_id] = asyncio.Lock()
+        self.users[chat_id] = self.users.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.users[chat_id] -= 1
+            if not self.users[chat_id]:
+                del self.users[chat_id]
+                del self.locks[chat_id]
 
-async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
+chat_locks = ChatLocks()
+
+@observe_latency('route_message')
+async def route_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Единый обработчик сообщений: классифицирует апдейт и передает его в конвейер группы или лички"""
+    if not update or not update.message or not update.message.from_user:
         return
-        
-    logger.info(f"📨 Получено личное сообщение от {update.message.from_user.id}: {update.message.text[:50] if update.message.text else '[медиа]'}...")
     
-    username = update.message.from_user.username
-    if is_manager(update.message.from_user.id, username):
-        await handle_manager_reply(update, context)
+    async with chat_locks.hold(update.message.chat.id):
+        await dispatch_message(update, context)
+
+async def dispatch_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Классифицирует сообщение и передает его в конвейер группы или лички"""
+    chat_kind, sender, kind = classify_message(update, context)
+    message = update.message
+    preview = message.text[:50] if message.text else '[медиа]'
+    if chat_kind == CHAT_GROUP:
+        logger.info(f"📨 Получено групповое сообщение: {message.chat.title} - {preview}...")
+    else:
+        logger.info(f"📨 Получено личное сообщение от {message.from_user.id}: {preview}...")
+    
+    if sender == SENDER_MANAGER:
+        if kind != KIND_COMMAND:
+            await handle_manager_reply(update, context)
         return
     
-    if not should_respond_to_message(update, context):
+    if sender == SENDER_BOT or kind != KIND_CONTENT:
         logger.info("❌ Сообщение не требует обработки")
         return
     
+    if chat_kind == CHAT_GROUP:
+        await handle_group_message(update, context)
+    elif chat_kind == CHAT_PRIVATE:
+        await handle_private_message(update, context)
+
+@observe_latency('handle_group_message')
+async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Конвейер сообщения клиента в группе: автоответ вне рабочего времени или учет в непрочитанных"""
+    chat_id = update.message.chat.id
+    replied_key = f'chat_{chat_id}'
+    
+    if not is_working_hours():
+        # Проверяем, не отправляли ли уже автоответ в этот чат
+        if not flags_manager.has_replied(replied_key):
+            await send_auto_reply(update, context)
+            flags_manager.set_replied(replied_key)
+            logger.info(f"✅ Автоответ отправлен в чат {chat_id}")
+        else:
+            logger.info(f"ℹ️ Автоответ уже был отправлен в чат {chat_id}, пропускаем")
+    else:
+        # В рабочее время сбрасываем флаг автоответа для этого чата
+        if flags_manager.has_replied(replied_key):
+            flags_manager.clear_replied(replied_key)
+            logger.info(f"🔄 Флаг автоответа сброшен для чата {chat_id} (рабочее время)")
+        
+        chat_title = update.message.chat.title
+        username = update.message.from_user.username
+        first_name = update.message.from_user.first_name
+        message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
+        
+        pending_messages_manager.add_message(
+            chat_id=update.message.chat.id,
+            user_id=update.message.from_user.id,
+            message_text=message_text,
+            message_id=update.message.message_id,
+            chat_title=chat_title,
+            username=username,
+            first_name=first_name
+        )
+        logger.info(f"✅ Добавлено в непрочитанные: чат '{chat_title}', пользователь {update.message.from_user.id}")
+        
+        # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
+        logger.info("📝 Новое сообщение добавлено, уведомление будет отправлено по расписанию")
+
+@observe_latency('handle_private_message')
+async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Конвейер личного сообщения клиента: автоответ вне рабочего времени или учет в непрочитанных"""
     user_id = update.message.from_user.id
     replied_key = f'user_{user_id}'
     
     if not is_working_hours():
         # Проверяем, не отправляли ли уже автоответ этому пользователю
         if not flags_manager.has_replied(replied_key):
-            await update.message.reply_text(AUTO_REPLY_MESSAGE)
+            await send_auto_reply(update, context)
             flags_manager.set_replied(replied_key)
             logger.info(f"✅ Автоответ отправлен пользователю {user_id}")
         else:
@@ -1631,24 +3572,23 @@ async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_T
             flags_manager.clear_replied(replied_key)
             logger.info(f"🔄 Флаг автоответа сброшен для пользователя {user_id} (рабочее время)")
         
-        # Добавляем сообщение в непрочитанные только если оно от клиента (не менеджера)
-        if not is_manager(update.message.from_user.id, username):
-            username = update.message.from_user.username
-            first_name = update.message.from_user.first_name
-            message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
-            
-            pending_messages_manager.add_message(
-                chat_id=update.message.chat.id,
-                user_id=update.message.from_user.id,
-                message_text=message_text,
-                message_id=update.message.message_id,
-                username=username,
-                first_name=first_name
-            )
-            logger.info(f"✅ Добавлено в непрочитанные: пользователь {first_name or username or user_id}")
-            
-            # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
-            logger.info("📝 Новое сообщение добавлено, уведомление будет отправлено по расписанию")
+        username = update.message.from_user.username
+        first_name = update.message.from_user.first_name
+        message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
+        
+        pending_messages_manager.add_message(
+            chat_id=update.message.chat.id,
+            user_id=update.message.from_user.id,
+            message_text=message_text,
+            message_id=update.message.message_id,
+            username=username,
+            first_name=first_name
+        )
+        logger.info(f"✅ Добавлено в непрочитанные: пользователь {first_name or username or user_id}")
+        
+        # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
+        logger.info("📝 Новое сообщение добавлено, уведомление будет отправлено по расписанию")
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок - логирует в консоль, но не отправляет уведомления в Telegram"""
     logger.error(f"💥 Ошибка при обработке сообщения: {context.error}")
@@ -1664,73 +3604,631 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # УБРАНА ОТПРАВКА УВЕДОМЛЕНИЙ АДМИНИСТРАТОРАМ
     # Ошибки будут только в консоли/логах, но не в Telegram
 
+# ========== РЕЖИМ ВЕБХУКА ==========
+
+def create_webhook_handler(application: Application) -> Callable:
+    """Создает обработчик POST-запросов Telegram: проверяет секрет и ставит обновление в очередь"""
+    
+    async def handle_webhook(request: HTTPRequest):
+        if WEBHOOK_SECRET_TOKEN:
+            received = request.headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(received, WEBHOOK_SECRET_TOKEN):
+                logger.warning("⚠️ Вебхук: неверный секретный токен, запрос отклонен")
+                return 403, b'', 'text/plain'
+        
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except Exception as e:
+            logger.warning(f"⚠️ Вебхук: не удалось разобрать обновление: {e}")
+            return 400, b'', 'text/plain'
+        
+        await application.update_queue.put(update)
+        return 200, b'', 'text/plain'
+    
+    return handle_webhook
+
+async def run_webhook(application: Application):
+    """Запускает бота в режиме вебхука до сигнала остановки"""
+    server = LocalHTTPServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.route('POST', WEBHOOK_PATH, create_webhook_handler(application))
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await server.start()
+        print(f"🌐 Вебхук слушает http://{WEBHOOK_LISTEN}:{server.port}{WEBHOOK_PATH}")
+        
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+                max_connections=max(1, UPDATE_WORKERS)
+            )
+            print(f"✅ Вебхук установлен: {WEBHOOK_URL}")
+        else:
+            print("⚠️ WEBHOOK_URL не задан - setWebhook не вызывается, обновления принимаются только локально")
+        
+        await application.start()
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# ========== ЭНДПОИНТ МЕТРИК ==========
+
+metrics_server = None
+
+def format_labels(**labels) -> str:
+    pairs = ','.join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+def render_histograms(lines: List[str], metric: str, help_text: str, label: str, family: Dict[str, Histogram]):
+    lines.append(f"# HELP {metric} {help_text}")
+    lines.append(f"# TYPE {metric} histogram")
+    for name, histogram in sorted(family.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            cumulative += count
+            lines.append(f"{metric}_bucket{format_labels(**{label: name, 'le': repr(bound)})} {cumulative}")
+        lines.append(f"{metric}_bucket{format_labels(**{label: name, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{metric}_sum{format_labels(**{label: name})} {histogram.sum!r}")
+        lines.append(f"{metric}_count{format_labels(**{label: name})} {histogram.count}")
+
+def render_registry(lines: List[str]):
+    """Значения MetricsRegistry; вызывается под metrics.lock"""
+    render_histograms(lines, 'bot_handler_duration_seconds', 'Время выполнения обработчиков и задач.',
+                      'handler', metrics.handler_latency)
+    render_histograms(lines, 'bot_api_request_duration_seconds', 'Время запросов к Bot API.',
+                      'method', metrics.api_latency)
+    
+    lines.append("# HELP bot_api_request_errors_total Неуспешные запросы к Bot API (код ответа или network).")
+    lines.append("# TYPE bot_api_request_errors_total counter")
+    for (endpoint, reason), count in sorted(metrics.api_errors.items()):
+        lines.append(f"bot_api_request_errors_total{format_labels(method=endpoint, reason=reason)} {count}")
+    
+    render_histograms(lines, 'bot_state_serialize_duration_seconds', 'Время сериализации файлов состояния (в event loop).',
+                      'file', metrics.serialize_latency)
+    render_histograms(lines, 'bot_state_write_duration_seconds', 'Время записи файлов состояния на диск.',
+                      'file', metrics.write_latency)
+    lines.append("# HELP bot_state_written_bytes_total Записано байт в файлы состояния.")
+    lines.append("# TYPE bot_state_written_bytes_total counter")
+    for name, size in sorted(metrics.write_bytes.items()):
+        lines.append(f"bot_state_written_bytes_total{format_labels(file=name)} {size}")
+
+def render_metrics() -> str:
+    """Метрики процесса в текстовом формате Prometheus 0.0.4"""
+    lines = []
+    with metrics.lock:
+        render_registry(lines)
+    
+    lines.append("# HELP bot_pending_messages Непрочитанные сообщения.")
+    lines.append("# TYPE bot_pending_messages gauge")
+    lines.append(f"bot_pending_messages {pending_messages_manager.count_messages()}")
+    lines.append("# HELP bot_pending_chats Чаты с непрочитанными сообщениями по воронкам (0 - еще без воронки).")
+    lines.append("# TYPE bot_pending_chats gauge")
+    for funnel_number, count in sorted(pending_messages_manager.count_chats_by_funnel().items()):
+        lines.append(f"bot_pending_chats{format_labels(funnel=funnel_number)} {count}")
+    lines.append("# HELP bot_auto_reply_flags Флаги отправленных автоответов.")
+    lines.append("# TYPE bot_auto_reply_flags gauge")
+    lines.append(f"bot_auto_reply_flags {flags_manager.count_flags()}")
+    lines.append("# HELP bot_state_write_queue Записи состояния, ожидающие потока записи.")
+    lines.append("# TYPE bot_state_write_queue gauge")
+    lines.append(f"bot_state_write_queue {state_writer.queue.qsize()}")
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics_request(request: HTTPRequest):
+    return 200, render_metrics().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+
+async def start_metrics_server(port: int = METRICS_PORT):
+    """Запускает эндпоинт метрик, если он включен"""
+    global metrics_server
+    if not metrics.enabled or metrics_server:
+        return
+    server = LocalHTTPServer(METRICS_LISTEN, port)
+    server.route('GET', METRICS_PATH, handle_metrics_request)
+    try:
+        await server.start()
+    except OSError as e:
+        logger.error(f"❌ Не удалось запустить эндпоинт метрик на порту {port}: {e}")
+        return
+    metrics_server = server
+    logger.info(f"📈 Метрики доступны на http://{METRICS_LISTEN}:{server.port}{METRICS_PATH}")
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server:
+        await metrics_server.stop()
+        metrics_server = None
+
+async def on_startup(application: Application):
+    """Запускает вспомогательные службы после инициализации бота"""
+    await start_metrics_server()
+    if shard_coordinator:
+        await shard_coordinator.start(application)
+
+# ========== ШАРДИРОВАНИЕ ==========
+
+def shard_for_chat(chat_id: int, shard_count: int = SHARD_COUNT) -> int:
+    return chat_id % shard_count
+
+def shard_for_message_key(key: str) -> int:
+    """Шард сообщения по ключу вида {chat_id}_{user_id}_{message_id}_{время}"""
+    return shard_for_chat(int(key.split('_', 1)[0]))
+
+def shard_for_flag_key(key: str) -> int:
+    """Шард флага автоответа: chat_{chat_id} или user_{user_id} (ID лички совпадает с ID пользователя)"""
+    try:
+        return shard_for_chat(int(key.split('_', 1)[1]))
+    except (IndexError, ValueError):
+        return 0
+
+class ConfigWatcher:
+    """Перечитывает общие файлы настроек, когда их изменил другой процесс"""
+    
+    def __init__(self):
+        self.watched: Dict[str, list] = {}
+    
+    @staticmethod
+    def get_mtime(path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+    
+    def watch(self, path: str, reload: Callable[[], None]):
+        self.watched[path] = [self.get_mtime(path), reload]
+    
+    def check(self) -> int:
+        reloaded = 0
+        for path, entry in self.watched.items():
+            mtime = self.get_mtime(path)
+            if mtime == entry[0]:
+                continue
+            entry[0] = mtime
+            try:
+                entry[1]()
+                reloaded += 1
+                logger.info(f"🔄 Перечитан файл настроек {path}")
+            except Exception as e:
+                logger.error(f"Ошибка перечитывания {path}: {e}")
+        return reloaded
+
+def split_state_into_shards() -> bool:
+    """Раскладывает общие файлы непрочитанных сообщений и флагов по файлам шардов.
+    
+    Выполняется один раз, при первом запуске с SHARD_COUNT > 1. Возвращает False,
+    если состояние уже разделено на другое число шардов.
+    """
+    saved_count = None
+    try:
+        if os.path.exists(SHARDS_FILE):
+            with open(SHARDS_FILE, 'r') as f:
+                saved_count = json.load(f).get('shard_count')
+    except Exception as e:
+        logger.error(f"Ошибка чтения {SHARDS_FILE}: {e}")
+        return False
+    
+    if saved_count == SHARD_COUNT:
+        return True
+    if saved_count is not None:
+        logger.error(f"❌ Состояние разделено на {saved_count} шардов, а SHARD_COUNT={SHARD_COUNT}")
+        return False
+    
+    if PENDING_STORAGE == 'sqlite' and os.path.exists(PENDING_DB_FILE):
+        messages = SqlitePendingStorage(PENDING_DB_FILE).load()
+    else:
+        messages = JsonPendingStorage().load()
+    
+    shard_messages = [{} for _ in range(SHARD_COUNT)]
+    for key, data in messages.items():
+        shard_messages[shard_for_chat(int(data['chat_id']))][key] = data
+    shard_flags = [{} for _ in range(SHARD_COUNT)]
+    for key, value in flags_manager.flags.items():
+        shard_flags[shard_for_flag_key(key)][key] = value
+    
+    # Снимок в формате JSON подхватывает и хранилище SQLite шарда при первом запуске
+    for shard_id in range(SHARD_COUNT):
+        state_writer.write_json(shard_file(PENDING_MESSAGES_FILE, shard_id), shard_messages[shard_id], indent=2)
+        state_writer.write_json(shard_file(FLAGS_FILE, shard_id), shard_flags[shard_id])
+    state_writer.write_json(SHARDS_FILE, {'shard_count': SHARD_COUNT})
+    state_writer.wait()
+    logger.info(f"🧩 Состояние разделено на {SHARD_COUNT} шардов: {len(messages)} сообщений, {len(flags_manager.flags)} флагов")
+    return True
+
+class ShardCoordinator:
+    """Процесс-приемник: запускает обработчики шардов, раздает им обновления
+    и держит в памяти копию их состояния для уведомления, отчетов и команд.
+    
+    Изменения, сделанные командами в процессе-приемнике, пересылаются шарду-владельцу,
+    который применяет их, сохраняет и присылает обратно - состояние шарда главное.
+    """
+    
+    def __init__(self, shard_count: int):
+        self.shard_count = shard_count
+        self.mp_context = multiprocessing.get_context('spawn')
+        self.inboxes = []
+        self.outbox = None
+        self.processes = []
+        self.reader_task = None
+        self.application = None
+    
+    def start_workers(self):
+        self.outbox = self.mp_context.Queue()
+        for shard_id in range(self.shard_count):
+            inbox = self.mp_context.Queue()
+            # Процесс-обработчик читает номер шарда из окружения при импорте модуля
+            os.environ['BOT_SHARD_ID'] = str(shard_id)
+            try:
+                process = self.mp_context.Process(
+                    target=run_shard_worker,
+                    args=(inbox, self.outbox),
+                    name=f"shard-{shard_id}",
+                    daemon=True
+                )
+                process.start()
+            finally:
+                del os.environ['BOT_SHARD_ID']
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        logger.info(f"🧩 Запущено обработчиков шардов: {self.shard_count}")
+    
+    async def start(self, application: Application):
+        """Начинает принимать изменения состояния от шардов (post_init приложения)"""
+        self.application = application
+        # Копия флагов собирается из снимков шардов
+        flags_manager.flags = {}
+        pending_messages_manager.change_listener = self.forward_pending_change
+        self.reader_task = asyncio.create_task(self.read_outbox())
+    
+    async def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            await asyncio.to_thread(process.join, 30)
+            if process.is_alive():
+                logger.warning(f"⚠️ Обработчик {process.name} не остановился, завершаем принудительно")
+                process.terminate()
+        if self.reader_task:
+            self.outbox.put(None)
+            await self.reader_task
+    
+    def forward_update(self, update: Update):
+        shard_id = shard_for_chat(update.effective_chat.id)
+        self.inboxes[shard_id].put(('update', update.to_dict()))
+    
+    def forward_pending_change(self, op: str, *args):
+        """Пересылает изменение, сделанное командой в процессе-приемнике, шарду-владельцу"""
+        if op == 'set':
+            key, data = args
+            self.inboxes[shard_for_message_key(key)].put(('set', key, data))
+        elif op == 'delete':
+            by_shard: Dict[int, List[str]] = {}
+            for key in args[0]:
+                by_shard.setdefault(shard_for_message_key(key), []).append(key)
+            for shard_id, keys in by_shard.items():
+                self.inboxes[shard_id].put(('delete', keys))
+        elif op == 'clear':
+            for inbox in self.inboxes:
+                inbox.put(('clear',))
+    
+    def drop_shard_messages(self, shard_id: int):
+        keys = [
+            key for key, message in pending_messages_manager.pending_messages.items()
+            if shard_for_chat(message.chat_id) == shard_id
+        ]
+        for key in keys:
+            pending_messages_manager.drop_message(key)
+    
+    async def read_outbox(self):
+        while True:
+            item = await asyncio.to_thread(self.outbox.get)
+            if item is None:
+                break
+            try:
+                await self.apply_shard_change(item[0], item[1], item[2:])
+            except Exception as e:
+                logger.error(f"💥 Ошибка применения изменения от шарда {item[0]}: {e}")
+    
+    async def apply_shard_change(self, shard_id: int, op: str, args: tuple):
+        """Применяет изменение состояния шарда к копии в памяти (без повторной пересылки)"""
+        manager = pending_messages_manager
+        if op == 'set':
+            key, data = args
+            manager.store_message(PendingMessage.from_dict(key, data))
+        elif op == 'delete':
+            for key in args[0]:
+                if key in manager.pending_messages:
+                    manager.drop_message(key)
+        elif op == 'clear':
+            self.drop_shard_messages(shard_id)
+        elif op == 'snapshot':
+            messages, flags = args
+            self.drop_shard_messages(shard_id)
+            for key, data in messages.items():
+                manager.store_message(PendingMessage.from_dict(key, data))
+            for key in [key for key in flags_manager.flags if shard_for_flag_key(key) == shard_id]:
+                del flags_manager.flags[key]
+            flags_manager.flags.update(flags)
+            logger.info(f"🧩 Шард {shard_id} подключен: {len(messages)} сообщений, {len(flags)} флагов")
+        elif op == 'flag':
+            key, value = args
+            if value is None:
+                flags_manager.flags.pop(key, None)
+            else:
+                flags_manager.flags[key] = value
+        elif op == 'refresh':
+            await request_notification_refresh(ContextTypes.DEFAULT_TYPE(self.application))
+
+shard_coordinator = ShardCoordinator(SHARD_COUNT) if IS_SHARD_INGEST else None
+
+async def forward_update_to_shard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик сообщений процесса-приемника: передает апдейт шарду, владеющему чатом"""
+    if update.effective_chat:
+        shard_coordinator.forward_update(update)
+
+class ShardLink:
+    """Связь процесса-обработчика с процессом-приемником: передает изменения состояния шарда"""
+    
+    def __init__(self, shard_id: int, outbox):
+        self.shard_id = shard_id
+        self.outbox = outbox
+    
+    def send(self, op: str, *args):
+        self.outbox.put((self.shard_id, op) + args)
+    
+    def on_pending_change(self, op: str, *args):
+        self.send(op, *args)
+    
+    def on_flag_change(self, key: str, value):
+        self.send('flag', key, value)
+    
+    def send_snapshot(self):
+        self.send('snapshot', pending_messages_manager.encode_all(), dict(flags_manager.flags))
+
+# Заполняется только в процессе-обработчике шарда
+shard_link = None
+config_watcher = ConfigWatcher()
+config_watcher.watch(BUSINESS_CALENDAR_FILE, business_calendar.reload)
+
+def apply_ingest_change(op: str, args: tuple):
+    """Применяет в шарде изменение, сделанное командой в процессе-приемнике"""
+    manager = pending_messages_manager
+    if op == 'set':
+        key, data = args
+        message = manager.pending_messages.get(key)
+        # Изменение относится к существующему сообщению; удаленное в шарде не восстанавливаем
+        if message is None or message.to_dict() == data:
+            return
+        manager.store_message(PendingMessage.from_dict(key, data))
+        manager.record_set(key)
+    elif op == 'delete':
+        keys = [key for key in args[0] if key in manager.pending_messages]
+        for key in keys:
+            manager.drop_message(key)
+        if keys:
+            manager.record_delete(keys)
+    elif op == 'clear':
+        manager.clear_all()
+
+async def reload_config_job(context: ContextTypes.DEFAULT_TYPE):
+    """Перечитывает файлы настроек, измененные извне или командами в процессе-приемнике"""
+    config_watcher.check()
+
+async def shard_funnel_job(context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет статусы воронок сообщений шарда"""
+    pending_messages_manager.update_funnel_statuses()
+
+def build_shard_application() -> Application:
+    """Приложение процесса-обработчика: обновления приходят от процесса-приемника, а не из Telegram"""
+    request, _ = create_http_requests(transport_stats)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .request(request)
+        # Общий лимит Telegram делится между обработчиками и процессом-приемником
+        .rate_limiter(PriorityRateLimiter(global_rate=OUTBOUND_GLOBAL_RATE / (SHARD_COUNT + 1)))
+        .concurrent_updates(max(1, UPDATE_WORKERS))
+        .updater(None)
+        .build()
+    )
+    application.add_handler(MessageHandler(ROUTED_MESSAGES, route_message))
+    application.add_error_handler(error_handler)
+    instrument_handlers(application)
+    
+    job_queue = application.job_queue
+    if job_queue:
+        job_queue.run_repeating(reload_config_job, interval=CONFIG_RELOAD_INTERVAL, first=CONFIG_RELOAD_INTERVAL)
+        job_queue.run_repeating(shard_funnel_job, interval=SHARD_FUNNEL_UPDATE_INTERVAL, first=SHARD_FUNNEL_UPDATE_INTERVAL)
+        job_queue.run_repeating(compact_state_job, interval=STATE_COMPACT_INTERVAL, first=60)
+        if message_body_store.policy == 'external':
+            job_queue.run_repeating(message_bodies_gc_job, interval=MESSAGE_BODIES_GC_INTERVAL, first=MESSAGE_BODIES_GC_INTERVAL)
+        if state_flusher.interval > 0:
+            job_queue.run_repeating(flush_state_job, interval=state_flusher.interval, first=state_flusher.interval)
+    else:
+        state_flusher.interval = 0
+        state_flusher.flush()
+    return application
+
+async def serve_shard(inbox, outbox):
+    """Цикл процесса-обработчика: обрабатывает апдейты и изменения от процесса-приемника"""
+    global shard_link
+    shard_link = ShardLink(SHARD_ID, outbox)
+    pending_messages_manager.change_listener = shard_link.on_pending_change
+    flags_manager.change_listener = shard_link.on_flag_change
+    config_watcher.watch(EXCLUDED_USERS_FILE, excluded_users_manager.reload)
+    config_watcher.watch(FUNNELS_CONFIG_FILE, funnels_config.reload)
+    
+    application = build_shard_application()
+    await application.initialize()
+    await application.start()
+    await start_metrics_server(METRICS_PORT + 1 + SHARD_ID)
+    shard_link.send_snapshot()
+    logger.info(f"🧩 Шард {SHARD_ID} запущен (pid {os.getpid()}), непрочитанных сообщений: {pending_messages_manager.count_messages()}")
+    
+    try:
+        while True:
+            item = await asyncio.to_thread(inbox.get)
+            if item is None:
+                break
+            if item[0] == 'update':
+                await application.update_queue.put(Update.de_json(item[1], application.bot))
+            else:
+                apply_ingest_change(item[0], item[1:])
+    finally:
+        # stop() дожидается обработки апдейтов, уже стоящих в очереди
+        await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
+        logger.info(f"🧩 Шард {SHARD_ID} остановлен")
+
+def run_shard_worker(inbox, outbox):
+    """Точка входа процесса-обработчика шарда"""
+    # Остановкой управляет процесс-приемник
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(inbox, outbox))
+
 # ========== ЗАПУСК БОТА ==========
 
+def build_application(request=None, get_updates_request=None) -> Application:
+    """Создает приложение бота: транспорт, обработчики и периодические задачи.
+    
+    Транспорт можно передать готовым (например, стенд нагрузочного тестирования
+    подставляет свою реализацию Bot API), иначе создаются HTTPXRequest по настройкам.
+    """
+    if request is None or get_updates_request is None:
+        request, get_updates_request = create_http_requests(transport_stats)
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(max(1, UPDATE_WORKERS))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if IS_SHARD_INGEST:
+        # Общий лимит Telegram делится между процессом-приемником и обработчиками шардов
+        builder.rate_limiter(PriorityRateLimiter(global_rate=OUTBOUND_GLOBAL_RATE / (SHARD_COUNT + 1)))
+    else:
+        builder.rate_limiter(PriorityRateLimiter())
+    application = builder.build()
+    
+    # Команды для управления воронками
+    application.add_handler(CommandHandler("funnels", funnels_command))
+    application.add_handler(CommandHandler("set_funnel_1", set_funnel_1_command))
+    application.add_handler(CommandHandler("set_funnel_2", set_funnel_2_command))
+    application.add_handler(CommandHandler("set_funnel_3", set_funnel_3_command))
+    application.add_handler(CommandHandler("reset_funnels", reset_funnels_command))
+    application.add_handler(CommandHandler("force_update_funnels", force_update_funnels_command))
+    application.add_handler(CommandHandler("debug_funnels", debug_funnels_command))
+    application.add_handler(CommandHandler("fix_funnels", fix_funnel_statuses_command))
+    
+    # Команды для обновления уведомления
+    application.add_handler(CommandHandler("update_notification", update_notification_command))
+    
+    # Команды для управления исключениями
+    application.add_handler(CommandHandler("add_exception", add_exception_command))
+    application.add_handler(CommandHandler("remove_exception", remove_exception_command))
+    application.add_handler(CommandHandler("list_exceptions", list_exceptions_command))
+    application.add_handler(CommandHandler("clear_exceptions", clear_exceptions_command))
+    
+    # Команды для ручного управления сообщениями
+    application.add_handler(CommandHandler("clear_chat", clear_chat_command))
+    application.add_handler(CommandHandler("clear_all", clear_all_command))
+    application.add_handler(CommandHandler("pending", pending_command))
+    
+    # Основные команды
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("set_work_chat", set_work_chat_command))
+    application.add_handler(CommandHandler("managers", managers_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("transport", transport_command))
+    application.add_handler(CommandHandler("reload_calendar", reload_calendar_command))
+    application.add_handler(CommandHandler("perf", perf_command))
+    
+    # Единый обработчик сообщений: группы и личка разводятся маршрутизатором;
+    # в режиме шардов сообщения обрабатывает шард, владеющий чатом
+    if IS_SHARD_INGEST:
+        application.add_handler(MessageHandler(ROUTED_MESSAGES, forward_update_to_shard))
+    else:
+        application.add_handler(MessageHandler(ROUTED_MESSAGES, route_message))
+    
+    # Обработчик ошибок
+    application.add_error_handler(error_handler)
+    instrument_handlers(application)
+    
+    # Периодическая проверка и отправка нового уведомления (каждые 15 минут)
+    job_queue = application.job_queue
+    if job_queue:
+        job_queue.run_repeating(timed_callback(check_and_send_new_notification), interval=1800, first=10)  # 15 минут
+        print("✅ Планировщик задач запущен (удаление старого + отправка нового каждые 15 минут)")
+        print("🛡️  COOLDOWN АКТИВИРОВАН - защита от частых отправок")
+        print("🔧 ЛОГИКА ВОРОНОК: Без дублирования (1 чат = 1 воронка)")
+        print("✅ СООБЩЕНИЯ ПОКАЗЫВАЮТСЯ ПОКА НЕ ОТВЕТЯТ")
+    
+        if state_flusher.interval > 0:
+            job_queue.run_repeating(flush_state_job, interval=state_flusher.interval, first=state_flusher.interval)
+            print(f"💾 Отложенное сохранение состояния: раз в {state_flusher.interval:g} сек.")
+        
+        job_queue.run_repeating(reload_config_job, interval=CONFIG_RELOAD_INTERVAL, first=CONFIG_RELOAD_INTERVAL)
+        if state_snapshot.enabled and STATE_SNAPSHOT_INTERVAL > 0:
+            job_queue.run_repeating(snapshot_state_job, interval=STATE_SNAPSHOT_INTERVAL, first=STATE_SNAPSHOT_INTERVAL)
+        
+        # Флаги шардов устаревают в процессах-обработчиках, приемник получает их удаление
+        if not IS_SHARD_INGEST:
+            job_queue.run_repeating(compact_state_job, interval=STATE_COMPACT_INTERVAL, first=60)
+        # Внешние тексты сообщений хранят обработчики шардов, процессу-приемнику чистить нечего
+        if message_body_store.policy == 'external' and not IS_SHARD_INGEST:
+            job_queue.run_repeating(message_bodies_gc_job, interval=MESSAGE_BODIES_GC_INTERVAL, first=MESSAGE_BODIES_GC_INTERVAL)
+    else:
+        print("❌ Планировщик задач недоступен")
+        # Без планировщика некому сбрасывать изменения на диск - сохраняем сразу
+        state_flusher.interval = 0
+        state_flusher.flush()
+    
+    return application
+
 def main():
     try:
         print("=" * 50)
         print("🤖 ЗАПУСК БОТА-АВТООТВЕТЧИКА")
         print("=" * 50)
         
-        application = Application.builder().token(BOT_TOKEN).build()
-        
-        # Команды для управления воронками
-        application.add_handler(CommandHandler("funnels", funnels_command))
-        application.add_handler(CommandHandler("set_funnel_1", set_funnel_1_command))
-        application.add_handler(CommandHandler("set_funnel_2", set_funnel_2_command))
-        application.add_handler(CommandHandler("set_funnel_3", set_funnel_3_command))
-        application.add_handler(CommandHandler("reset_funnels", reset_funnels_command))
-        application.add_handler(CommandHandler("force_update_funnels", force_update_funnels_command))
-        application.add_handler(CommandHandler("debug_funnels", debug_funnels_command))
-        application.add_handler(CommandHandler("fix_funnels", fix_funnel_statuses_command))
-        
-        # Команды для обновления уведомления
-        application.add_handler(CommandHandler("update_notification", update_notification_command))
-        
-        # Команды для управления исключениями
-        application.add_handler(CommandHandler("add_exception", add_exception_command))
-        application.add_handler(CommandHandler("remove_exception", remove_exception_command))
-        application.add_handler(CommandHandler("list_exceptions", list_exceptions_command))
-        application.add_handler(CommandHandler("clear_exceptions", clear_exceptions_command))
-        
-        # Команды для ручного управления сообщениями
-        application.add_handler(CommandHandler("clear_chat", clear_chat_command))
-        application.add_handler(CommandHandler("clear_all", clear_all_command))
-        application.add_handler(CommandHandler("pending", pending_command))
-        
-        # Основные команды
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("status", status_command))
-        application.add_handler(CommandHandler("set_work_chat", set_work_chat_command))
-        application.add_handler(CommandHandler("managers", managers_command))
-        application.add_handler(CommandHandler("stats", stats_command))
-        
-        # Обработчики сообщений
-        application.add_handler(MessageHandler(
-            filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL, 
-            handle_group_message,
-            block=False
-        ))
-        application.add_handler(MessageHandler(
-            filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL,
-            handle_private_message, 
-            block=False
-        ))
+        if IS_SHARD_INGEST:
+            if not split_state_into_shards():
+                print("❌ Число шардов не совпадает с разделенным состоянием, запуск остановлен")
+                return
         
-        # Обработчик ошибок
-        application.add_error_handler(error_handler)
-        
-        # Периодическая проверка и отправка нового уведомления (каждые 15 минут)
-        job_queue = application.job_queue
-        if job_queue:
-            job_queue.run_repeating(check_and_send_new_notification, interval=1800, first=10)  # 15 минут
-            print("✅ Планировщик задач запущен (удаление старого + отправка нового каждые 15 минут)")
-            print("🛡️  COOLDOWN АКТИВИРОВАН - защита от частых отправок")
-            print("🔧 ЛОГИКА ВОРОНОК: Без дублирования (1 чат = 1 воронка)")
-            print("✅ СООБЩЕНИЯ ПОКАЗЫВАЮТСЯ ПОКА НЕ ОТВЕТЯТ")
-        else:
-            print("❌ Планировщик задач недоступен")
+        application = build_application()
+        
+        if IS_SHARD_INGEST:
+            shard_coordinator.start_workers()
+            print(f"🧩 Шардирование: {SHARD_COUNT} процессов-обработчиков")
+        if BOT_API_BASE_URL != TELEGRAM_API_BASE_URL:
+            print(f"🧪 Bot API: {BOT_API_BASE_URL}")
+        if metrics.enabled:
+            print(f"📈 Метрики: http://{METRICS_LISTEN}:{METRICS_PORT}{METRICS_PATH}")
         
         # Запуск
         FUNNELS = funnels_config.get_funnels()
@@ -1739,9 +4237,10 @@ def main():
         
         print("🚀 Бот запускается...")
         print(f"📊 Загружено флагов: {flags_manager.count_flags()}")
-        print(f"📋 Непрочитанных сообщений: {len(pending_messages_manager.get_all_pending_messages())}")
+        print(f"📋 Непрочитанных сообщений: {pending_messages_manager.count_messages()}")
         print(f"👥 Менеджеров в системе: {total_excluded}")
         print(f"⚙️ Воронки уведомлений: {FUNNELS}")
+        print(format_startup_report())
         
         if work_chat_manager.is_work_chat_set():
             print(f"💬 Рабочий чат установлен: {work_chat_manager.get_work_chat_id()}")
@@ -1755,11 +4254,14 @@ def main():
         print("⏰ Ожидание сообщений...")
         print("=" * 50)
         
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=False,
-            close_loop=False
-        )
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False,
+                close_loop=False
+            )
         
     except Exception as e:
         print(f"💥 КРИТИЧЕСКАЯ ОШИБКА: {e}")
@@ -0,0 +1,328 @@
+"""Локальная замена Telegram Bot API для проверки бота без сети.
+
+Реализует методы, которыми пользуется бот: getMe, getUpdates (long polling),
+sendMessage, editMessageText, deleteMessage, setWebhook/deleteWebhook/getWebhookInfo.
+Задержки, ответы 429 (flood control) и ошибки сервера внедряются по вероятности
+или поштучно для конкретного метода.
+
+Бот направляется на сервер через BOT_API_BASE_URL:
+    python fake_bot_api.py --port 8081 --latency 0.05 --flood 0.05
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+
+Управление запущенным сервером (JSON в теле запроса):
+    POST /_control/updates  - добавить апдейт (или список апдейтов) для getUpdates
+    POST /_control/faults   - изменить параметры сбоев (latency, jitter, flood, retry_after, errors)
+    POST /_control/reset    - очистить сообщения, апдейты и счетчики
+    GET  /_control/sent     - отправленные ботом сообщения и счетчики вызовов
+
+Модуль не импортирует bot.py (общий с ботом HTTP-сервер - в local_http.py), поэтому
+может работать рядом с ботом в одном процессе (см. loadtest.py --transport http) или отдельно.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import signal
+from collections import Counter
+from time import time as unix_time
+from typing import Any, Dict, List
+from urllib.parse import parse_qsl
+
+from local_http import HTTP_STATUS_TEXT, HTTPRequest, LocalHTTPServer
+
+logger = logging.getLogger(__name__)
+
+class APIError(Exception):
+    """Ответ Bot API с ok=false"""
+
+    def __init__(self, status: int, description: str, retry_after: int = None):
+        super().__init__(description)
+        self.status = status
+        self.description = description
+        self.retry_after = retry_after
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"ok": False, "error_code": self.status, "description": self.description}
+        if self.retry_after is not None:
+            data["parameters"] = {"retry_after": self.retry_after}
+        return data
+
+class Faults:
+    """Параметры внедряемых сбоев"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood: float = 0.0,
+                 retry_after: int = 1, errors: float = 0.0, seed: int = None):
+        # Задержка каждого ответа (кроме ожидания в getUpdates) и ее случайный разброс
+        self.latency = latency
+        self.jitter = jitter
+        # Вероятность ответа 429 и его retry_after (секунды)
+        self.flood = flood
+        self.retry_after = retry_after
+        # Вероятность ответа 500
+        self.errors = errors
+        # Поштучные сбои: метод -> [(статус, retry_after), ...]
+        self.scripted: Dict[str, List[tuple]] = {}
+        self.random = random.Random(seed)
+
+    def update(self, **settings):
+        for name in ('latency', 'jitter', 'flood', 'retry_after', 'errors'):
+            if name in settings:
+                setattr(self, name, type(getattr(self, name))(settings[name]))
+
+    def inject(self, method: str, status: int = 429, count: int = 1, retry_after: int = None):
+        """Следующие count вызовов метода завершатся ошибкой status"""
+        self.scripted.setdefault(method, []).extend([(status, retry_after)] * count)
+
+    def delay(self) -> float:
+        if not self.jitter:
+            return self.latency
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def check(self, method: str):
+        """Бросает APIError, если этот вызов должен завершиться сбоем"""
+        scripted = self.scripted.get(method)
+        if scripted:
+            status, retry_after = scripted.pop(0)
+        elif self.flood and self.random.random() < self.flood:
+            status, retry_after = 429, None
+        elif self.errors and self.random.random() < self.errors:
+            status, retry_after = 500, None
+        else:
+            return
+        if status == 429:
+            retry_after = self.retry_after if retry_after is None else retry_after
+            raise APIError(429, f"Too Many Requests: retry after {retry_after}", retry_after)
+        raise APIError(status, HTTP_STATUS_TEXT.get(status, 'Error'))
+
+class FakeBotAPI:
+    """Состояние поддельного Bot API: сообщения чатов, очередь апдейтов, журнал вызовов"""
+
+    def __init__(self, faults: Faults = None, bot_id: int = 1, bot_username: str = 'fake_bot'):
+        self.faults = faults or Faults()
+        self.bot_user = {"id": bot_id, "is_bot": True, "first_name": "FakeBot", "username": bot_username}
+        self.reset()
+
+    def reset(self):
+        self.messages: Dict[tuple, Dict[str, Any]] = {}
+        self.sent: List[Dict[str, Any]] = []
+        self.calls = Counter()
+        self.updates: List[Dict[str, Any]] = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.new_updates = asyncio.Event()
+        self.webhook_url = ''
+
+    # ---------- апдейты ----------
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        """Добавляет апдейт для getUpdates; update_id назначается, если не указан"""
+        update = dict(update)
+        update.setdefault("update_id", next(self.update_ids))
+        self.updates.append(update)
+        self.new_updates.set()
+        return update["update_id"]
+
+    def push_message(self, chat_id: int, user_id: int, text: str, chat_title: str = None,
+                     username: str = None, first_name: str = None) -> int:
+        """Добавляет апдейт с сообщением пользователя"""
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        if chat_id < 0:
+            chat["title"] = chat_title or f"Chat {chat_id}"
+        sender = {"id": user_id, "is_bot": False, "first_name": first_name or f"user{user_id}"}
+        if username:
+            sender["username"] = username
+        return self.push_update({"message": {
+            "message_id": next(self.message_ids),
+            "date": int(unix_time()),
+            "chat": chat,
+            "from": sender,
+            "text": text,
+        }})
+
+    async def get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        if offset:
+            # Как и в Telegram, offset подтверждает все апдейты с меньшим update_id
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout > 0:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    # ---------- сообщения ----------
+
+    def chat(self, chat_id: int) -> Dict[str, Any]:
+        if chat_id > 0:
+            return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+        return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+
+    def send_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        if 'chat_id' not in params or not params.get('text'):
+            raise APIError(400, "Bad Request: chat_id and text are required")
+        chat_id = int(params['chat_id'])
+        message = {
+            "message_id": next(self.message_ids),
+            "from": self.bot_user,
+            "chat": self.chat(chat_id),
+            "date": int(unix_time()),
+            "text": params['text'],
+        }
+        self.messages[(chat_id, message["message_id"])] = message
+        self.sent.append({"method": "sendMessage", "chat_id": chat_id,
+                          "message_id": message["message_id"], "text": params['text']})
+        return message
+
+    def edit_message_text(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        key = (int(params.get('chat_id', 0)), int(params.get('message_id', 0)))
+        message = self.messages.get(key)
+        if message is None:
+            raise APIError(400, "Bad Request: message to edit not found")
+        if message["text"] == params.get('text'):
+            raise APIError(400, "Bad Request: message is not modified")
+        message["text"] = params.get('text')
+        message["edit_date"] = int(unix_time())
+        self.sent.append({"method": "editMessageText", "chat_id": key[0], "message_id": key[1], "text": message["text"]})
+        return message
+
+    def delete_message(self, params: Dict[str, Any]) -> bool:
+        key = (int(params.get('chat_id', 0)), int(params.get('message_id', 0)))
+        if self.messages.pop(key, None) is None:
+            raise APIError(400, "Bad Request: message to delete not found")
+        self.sent.append({"method": "deleteMessage", "chat_id": key[0], "message_id": key[1]})
+        return True
+
+    # ---------- диспетчеризация ----------
+
+    async def call(self, method: str, params: Dict[str, Any]) -> Any:
+        self.calls[method] += 1
+        if method != 'getUpdates':
+            delay = self.faults.delay()
+            if delay:
+                await asyncio.sleep(delay)
+        self.faults.check(method)
+
+        if method == 'getMe':
+            return self.bot_user
+        if method == 'getUpdates':
+            return await self.get_updates(params)
+        if method == 'sendMessage':
+            return self.send_message(params)
+        if method == 'editMessageText':
+            return self.edit_message_text(params)
+        if method == 'deleteMessage':
+            return self.delete_message(params)
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = ''
+            return True
+        if method == 'getWebhookInfo':
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": len(self.updates)}
+        if method in ('close', 'logOut'):
+            return True
+        raise APIError(404, "Not Found: method not found")
+
+def parse_params(headers: Dict[str, str], body: bytes, query: str) -> Dict[str, Any]:
+    """Параметры запроса: JSON, form-urlencoded или строка запроса.
+
+    PTB передает значения формы строками, а вложенные объекты - JSON-строками.
+    """
+    params: Dict[str, Any] = dict(parse_qsl(query))
+    content_type = headers.get('content-type', '')
+    if body and 'application/json' in content_type:
+        params.update(json.loads(body))
+    elif body:
+        params.update(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+    return params
+
+class FakeBotAPIServer(LocalHTTPServer):
+    """HTTP-сервер с путями вида /bot<токен>/<метод> и /_control/<действие>"""
+
+    def __init__(self, api: FakeBotAPI, host: str = '127.0.0.1', port: int = 0):
+        super().__init__(host, port)
+        self.api = api
+
+    @property
+    def base_url(self) -> str:
+        """Значение для BOT_API_BASE_URL"""
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def dispatch(self, request: HTTPRequest):
+        status, payload = await self.handle(request)
+        return status, json.dumps(payload).encode('utf-8'), 'application/json'
+
+    async def handle(self, request: HTTPRequest):
+        try:
+            params = parse_params(request.headers, request.body, request.query)
+        except ValueError:
+            return 400, APIError(400, "Bad Request: can't parse request").to_dict()
+
+        if request.path.startswith('/_control/'):
+            return await self.control(request.method, request.path[len('/_control/'):], params)
+
+        parts = request.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            return 404, APIError(404, "Not Found").to_dict()
+        try:
+            result = await self.api.call(parts[1], params)
+        except APIError as e:
+            return e.status, e.to_dict()
+        except (KeyError, TypeError, ValueError) as e:
+            return 400, APIError(400, f"Bad Request: {e}").to_dict()
+        return 200, {"ok": True, "result": result}
+
+    async def control(self, method: str, action: str, params: Dict[str, Any]):
+        if action == 'updates' and method == 'POST':
+            updates = params.get('updates', [params])
+            return 200, {"ok": True, "result": [self.api.push_update(update) for update in updates]}
+        if action == 'faults' and method == 'POST':
+            self.api.faults.update(**params)
+            return 200, {"ok": True, "result": True}
+        if action == 'reset' and method == 'POST':
+            self.api.reset()
+            return 200, {"ok": True, "result": True}
+        if action == 'sent' and method == 'GET':
+            return 200, {"ok": True, "result": {"sent": self.api.sent, "calls": dict(self.api.calls)}}
+        return 404, APIError(404, "Not Found").to_dict()
+
+async def serve(args):
+    api = FakeBotAPI(Faults(args.latency, args.jitter, args.flood, args.retry_after, args.errors, args.seed))
+    server = FakeBotAPIServer(api, args.host, args.port)
+    await server.start()
+    print(f"🧪 Поддельный Bot API: BOT_API_BASE_URL={server.base_url}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        print(f"📊 Вызовы: {dict(api.calls)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа (секунды)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайный разброс задержки (секунды)")
+    parser.add_argument('--flood', type=float, default=0.0, help="вероятность ответа 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429 (секунды)")
+    parser.add_argument('--errors', type=float, default=0.0, help="вероятность ответа 500")
+    parser.add_argument('--seed', type=int, default=None)
+    asyncio.run(serve(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
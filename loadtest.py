@@ -0,0 +1,328 @@
+"""Нагрузочный стенд бота: настоящие обработчики, поддельный Bot API в том же процессе.
+
+Приложение собирается той же build_application, что и в боевом запуске, а запросы
+к Telegram обслуживает FakeBotAPI из fake_bot_api.py - без сети и без токена:
+напрямую через транспорт PTB (--transport memory, апдейты кладутся в очередь приложения)
+или по HTTP с long polling (--transport http, весь путь getUpdates/sendMessage). Стенд создает
+непрочитанные сообщения (--backlog), подает поток групповых, личных сообщений и ответов
+менеджеров с заданной частотой и выводит пропускную способность, задержки обработчиков
+(p50/p99) и объем записанного на диск.
+
+Состояние бота создается во временном каталоге, файлы рабочего каталога не затрагиваются.
+
+Примеры:
+    python loadtest.py --backlog 10000 --group-rate 200 --private-rate 50 --manager-rate 5
+    python loadtest.py --backlog 10000 --burst 20000          # максимальная пропускная способность
+    python loadtest.py --after-hours --private-rate 100        # вне рабочего времени (автоответы)
+    python loadtest.py --transport http --api-latency 0.05 --flood 0.02
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import perf_counter, time as unix_time
+
+from telegram.request import BaseRequest
+
+from fake_bot_api import APIError, FakeBotAPI, FakeBotAPIServer, Faults
+
+# Менеджер, от имени которого идут ответы в группах
+MANAGER_USER_ID = 500
+# Рабочий чат, куда бот отправляет сводное уведомление
+WORK_CHAT_ID = -1000
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд бота с поддельным Bot API")
+    parser.add_argument('--backlog', type=int, default=10000, help="непрочитанных сообщений до начала теста")
+    parser.add_argument('--group-rate', type=float, default=100, help="групповых сообщений клиентов в секунду")
+    parser.add_argument('--private-rate', type=float, default=20, help="личных сообщений в секунду")
+    parser.add_argument('--manager-rate', type=float, default=2, help="ответов менеджеров в секунду")
+    parser.add_argument('--duration', type=float, default=10, help="длительность подачи потока (секунды)")
+    parser.add_argument('--burst', type=int, default=0,
+                        help="подать сразу N апдейтов в пропорции частот вместо равномерного потока")
+    parser.add_argument('--chats', type=int, default=500, help="число групповых чатов")
+    parser.add_argument('--users', type=int, default=2000, help="число клиентов в личке")
+    parser.add_argument('--transport', choices=('memory', 'http'), default='memory',
+                        help="memory - Bot API в памяти, http - локальный сервер и long polling")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа поддельного Bot API (секунды)")
+    parser.add_argument('--flood', type=float, default=0.0, help="вероятность ответа 429 от Bot API")
+    parser.add_argument('--errors', type=float, default=0.0, help="вероятность ответа 500 от Bot API")
+    parser.add_argument('--workers', type=int, default=None, help="UPDATE_WORKERS (по умолчанию как в боте)")
+    parser.add_argument('--flush-interval', type=float, default=5, help="STATE_FLUSH_INTERVAL")
+    parser.add_argument('--body-policy', default='full', help="MESSAGE_BODY_POLICY")
+    parser.add_argument('--storage', default='json', help="PENDING_STORAGE")
+    parser.add_argument('--after-hours', action='store_true', help="нерабочее время: клиенты получают автоответы")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="оставить ограничения исходящих запросов Telegram (по умолчанию сняты)")
+    parser.add_argument('--log-level', default='WARNING', help="уровень логов бота")
+    parser.add_argument('--keep', action='store_true', help="не удалять временный каталог")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+def prepare_environment(args) -> str:
+    """Создает временный каталог с конфигурацией и задает переменные окружения до импорта бота"""
+    workdir = tempfile.mkdtemp(prefix='bot-loadtest-')
+    os.chdir(workdir)
+
+    windows = [] if args.after_hours else [["00:00", "24:00"]]
+    with open('business_calendar.json', 'w') as f:
+        json.dump({"weekdays": {str(day): windows for day in range(7)}, "holidays": []}, f)
+    with open('excluded_users.json', 'w') as f:
+        json.dump({"user_ids": [MANAGER_USER_ID], "usernames": []}, f)
+    with open('work_chat.json', 'w') as f:
+        json.dump({"work_chat_id": WORK_CHAT_ID}, f)
+
+    os.environ.update({
+        'BOT_TOKEN': '123456:LOADTEST',
+        'SHARD_COUNT': '1',
+        'METRICS_PORT': '0',
+        'STATE_FLUSH_INTERVAL': str(args.flush_interval),
+        'MESSAGE_BODY_POLICY': args.body_policy,
+        'PENDING_STORAGE': args.storage,
+    })
+    if args.workers is not None:
+        os.environ['UPDATE_WORKERS'] = str(args.workers)
+    if not args.telegram_limits:
+        os.environ.update({
+            'OUTBOUND_GLOBAL_RATE': '1000000',
+            'OUTBOUND_PRIVATE_RATE': '1000000',
+            'OUTBOUND_GROUP_PER_MINUTE': '1000000000',
+            'OUTBOUND_CHAT_BURST': '1000000',
+        })
+    return workdir
+
+class FakeBotAPIRequest(BaseRequest):
+    """Транспорт PTB, передающий вызовы Bot API в FakeBotAPI без HTTP"""
+
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        params = request_data.parameters if request_data else {}
+        try:
+            result = await self.api.call(url.rsplit('/', 1)[-1], params)
+        except APIError as e:
+            return e.status, json.dumps(e.to_dict()).encode('utf-8')
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+class TrafficGenerator:
+    """Синтетические апдейты: сообщения клиентов в группах и в личке, ответы менеджеров"""
+
+    def __init__(self, args):
+        self.random = random.Random(args.seed)
+        self.group_chats = [-(2_000_000 + i) for i in range(max(1, args.chats))]
+        self.users = [10_000 + i for i in range(max(1, args.users))]
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def message(self, chat: dict, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(unix_time()),
+                "chat": chat,
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+                "text": text,
+            },
+        }
+
+    def group_chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "supergroup", "title": f"Группа {-chat_id}"}
+
+    def group_message(self) -> dict:
+        chat_id = self.random.choice(self.group_chats)
+        return self.message(self.group_chat(chat_id), self.random.choice(self.users), "Здравствуйте, есть вопрос по заказу")
+
+    def private_message(self) -> dict:
+        user_id = self.random.choice(self.users)
+        return self.message({"id": user_id, "type": "private", "first_name": f"user{user_id}"}, user_id, "Добрый день!")
+
+    def manager_reply(self) -> dict:
+        chat_id = self.random.choice(self.group_chats)
+        return self.message(self.group_chat(chat_id), MANAGER_USER_ID, "Отвечаю на ваш вопрос")
+
+    def seed_backlog(self, manager, count: int):
+        """Непрочитанные сообщения, накопленные до начала теста"""
+        for _ in range(count):
+            update = self.group_message()["message"]
+            manager.add_message(
+                chat_id=update["chat"]["id"],
+                user_id=update["from"]["id"],
+                message_text=update["text"],
+                message_id=update["message_id"],
+                chat_title=update["chat"]["title"],
+                username=update["from"]["username"],
+                first_name=update["from"]["first_name"]
+            )
+
+def create_latency_recorder(registry_class):
+    """Включенный реестр метрик бота, который дополнительно хранит все замеры обработчиков
+    (для точных перцентилей в пределах одного прогона, а не корзин гистограмм)"""
+
+    class LatencyRecorder(registry_class):
+        def __init__(self):
+            super().__init__(enabled=True)
+            self.samples = {}
+
+        def observe_handler(self, name: str, seconds: float):
+            super().observe_handler(name, seconds)
+            self.samples.setdefault(name, []).append(seconds)
+
+        def count(self, name: str) -> int:
+            return len(self.samples.get(name, ()))
+
+    return LatencyRecorder()
+
+def state_size() -> int:
+    """Суммарный размер файлов состояния в рабочем каталоге"""
+    total = 0
+    for root, _, files in os.walk('.'):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+async def feed_traffic(submit, traffic: TrafficGenerator, args) -> int:
+    """Подает апдейты через submit(update_dict); возвращает число поданных апдейтов"""
+    rates = [(traffic.group_message, args.group_rate), (traffic.private_message, args.private_rate),
+             (traffic.manager_reply, args.manager_rate)]
+    rates = [(make, rate) for make, rate in rates if rate > 0]
+    if not rates:
+        return 0
+
+    if args.burst:
+        makers, weights = zip(*rates)
+        for make in traffic.random.choices(makers, weights=weights, k=args.burst):
+            await submit(make())
+        return args.burst
+
+    # Равномерный поток: на каждом шаге добираем апдейты, которые уже должны были прийти
+    sent = [0] * len(rates)
+    started = perf_counter()
+    while True:
+        elapsed = min(perf_counter() - started, args.duration)
+        for index, (make, rate) in enumerate(rates):
+            due = int(elapsed * rate)
+            while sent[index] < due:
+                await submit(make())
+                sent[index] += 1
+        if elapsed >= args.duration:
+            return sum(sent)
+        await asyncio.sleep(0.005)
+
+async def run(args):
+    from telegram import Update
+
+    api = FakeBotAPI(Faults(latency=args.api_latency, flood=args.flood, errors=args.errors, seed=args.seed))
+    server = None
+    if args.transport == 'http':
+        server = FakeBotAPIServer(api)
+        await server.start()
+        # Адрес Bot API читается при импорте бота
+        os.environ['BOT_API_BASE_URL'] = server.base_url
+
+    import bot
+    logging.getLogger(bot.__name__).setLevel(args.log_level.upper())
+
+    # Реестр метрик заменяется до первых замеров: все обращения идут через bot.metrics
+    recorder = bot.metrics = create_latency_recorder(bot.MetricsRegistry)
+
+    traffic = TrafficGenerator(args)
+    seed_started = perf_counter()
+    traffic.seed_backlog(bot.pending_messages_manager, args.backlog)
+    bot.state_flusher.flush()
+    await asyncio.to_thread(bot.state_writer.wait)
+    print(f"📋 Подготовлено непрочитанных сообщений: {bot.pending_messages_manager.count_messages()} "
+          f"за {perf_counter() - seed_started:.2f} сек.")
+    bot.metrics.write_bytes.clear()
+    size_before = state_size()
+
+    if server:
+        application = bot.build_application()
+    else:
+        request = FakeBotAPIRequest(api)
+        application = bot.build_application(request=request, get_updates_request=request)
+    await application.initialize()
+    await application.start()
+
+    if server:
+        await application.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=Update.ALL_TYPES)
+
+        async def submit(update):
+            api.push_update(update)
+    else:
+        async def submit(update):
+            await application.update_queue.put(Update.de_json(update, application.bot))
+
+    started = perf_counter()
+    total = await feed_traffic(submit, traffic, args)
+    fed = perf_counter() - started
+
+    # Каждый апдейт проходит через route_message ровно один раз
+    while recorder.count('route_message') < total:
+        await asyncio.sleep(0.01)
+    elapsed = perf_counter() - started
+
+    if server:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await bot.on_shutdown(application)
+    if server:
+        await server.stop()
+
+    print("=" * 50)
+    print(f"📨 Апдейтов: {total}, подача {fed:.2f} сек., обработка {elapsed:.2f} сек.")
+    print(f"🚀 Пропускная способность: {total / elapsed if elapsed else 0:.0f} апдейтов/сек.")
+    print("⏱️ Задержки обработчиков (мс):")
+    for name, samples in sorted(recorder.samples.items()):
+        samples.sort()
+        print(f"   {name}: n={len(samples)} p50={percentile(samples, 0.5) * 1000:.3f} "
+              f"p99={percentile(samples, 0.99) * 1000:.3f} max={samples[-1] * 1000:.3f}")
+    written = sum(bot.metrics.write_bytes.values())
+    print(f"💾 Записано на диск: {written / 1024:.1f} КБ ({written / total if total else 0:.0f} байт на апдейт)")
+    for name, size in sorted(bot.metrics.write_bytes.items()):
+        print(f"   {name}: {size / 1024:.1f} КБ")
+    # Запись в SQLite идет через транзакции, их объем виден только по размеру файлов
+    print(f"📁 Размер файлов состояния: {size_before / 1024:.1f} КБ -> {state_size() / 1024:.1f} КБ")
+    print(f"🌐 Вызовы Bot API: {dict(api.calls)}")
+    for endpoint, stats in sorted(bot.transport_stats.endpoints.items()):
+        print(f"   {endpoint}: сред. {stats.total_seconds / stats.requests * 1000:.1f} мс, ошибок {stats.errors}")
+    print(f"📋 Непрочитанных сообщений после теста: {bot.pending_messages_manager.count_messages()}")
+    print("=" * 50)
+    bot.state_writer.stop()
+
+def main():
+    args = parse_args()
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = prepare_environment(args)
+    sys.path.insert(0, repo_dir)
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if args.keep:
+            print(f"📁 Каталог состояния: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Минимальный HTTP/1.1-сервер на asyncio.
+
+Используется ботом (вебхук, эндпоинт метрик) и поддельным Bot API из fake_bot_api.py,
+поэтому вынесен в отдельный модуль: fake_bot_api.py не импортирует bot.py.
+"""
+import asyncio
+import logging
+from typing import Dict, Callable
+
+logger = logging.getLogger(__name__)
+
+class HTTPRequest:
+    """Входящий HTTP-запрос"""
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+    
+    def __init__(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+HTTP_STATUS_TEXT = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+    429: 'Too Many Requests', 500: 'Internal Server Error', 502: 'Bad Gateway',
+}
+
+class LocalHTTPServer:
+    """Минимальный HTTP/1.1-сервер на asyncio (keep-alive, тело только с Content-Length).
+    
+    Обработчик маршрута получает HTTPRequest и возвращает (статус, тело, content-type).
+    """
+    
+    MAX_BODY_SIZE = 10 * 1024 * 1024
+    
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes: Dict[tuple, Callable] = {}
+        self.server = None
+        self.connections: Dict[asyncio.StreamWriter, asyncio.Task] = {}
+    
+    def route(self, method: str, path: str, handler: Callable):
+        self.routes[(method.upper(), path)] = handler
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        if self.port == 0:
+            self.port = self.server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            # Закрываем простаивающие keep-alive соединения, иначе сервер ждет их вечно
+            for writer in list(self.connections):
+                writer.close()
+            await asyncio.gather(*self.connections.values(), return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+    
+    async def read_request(self, reader: asyncio.StreamReader):
+        """Читает один запрос; None - соединение закрыто клиентом"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        path, _, query = target.partition('?')
+        return HTTPRequest(method.upper(), path, query, headers, b'')
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError:
+                    await self.write_response(writer, 400, b'', close=True)
+                    break
+                if request is None:
+                    break
+                
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                if 'transfer-encoding' in request.headers:
+                    await self.write_response(writer, 411, b'', close=True)
+                    break
+                length = int(request.headers.get('content-length', '0') or 0)
+                if length > self.MAX_BODY_SIZE:
+                    await self.write_response(writer, 413, b'', close=True)
+                    break
+                if length:
+                    request.body = await reader.readexactly(length)
+                
+                status, body, content_type = await self.dispatch(request)
+                await self.write_response(writer, status, body, content_type, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+    
+    async def dispatch(self, request: HTTPRequest):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self.routes)
+            return (405 if known_path else 404), b'', 'text/plain'
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"💥 Ошибка обработки HTTP-запроса {request.method} {request.path}: {e}")
+            return 500, b'', 'text/plain'
+    
+    async def write_response(self, writer: asyncio.StreamWriter, status: int, body: bytes,
+                             content_type: str = 'text/plain', close: bool = False):
+        head = (
+            f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
@@ -0,0 +1,93 @@
+"""Проверка бота без сети: режим вебхука против поддельного Bot API из fake_bot_api.py"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI, FakeBotAPIServer  # noqa: E402
+
+SECRET = 'test-secret'
+CLIENT_ID = 555
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def post(url: str, body: bytes, secret: str = SECRET) -> int:
+    request = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+async def wait_for(condition, timeout: float = 20.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "условие не выполнилось вовремя"
+        await asyncio.sleep(0.05)
+
+
+def port_open(port: int) -> bool:
+    with socket.socket() as sock:
+        return sock.connect_ex(('127.0.0.1', port)) == 0
+
+
+async def run_scenario(workdir: str):
+    api = FakeBotAPI()
+    server = FakeBotAPIServer(api)
+    await server.start()
+
+    # Рабочих окон нет: любое сообщение клиента приходит в нерабочее время
+    with open(os.path.join(workdir, 'business_calendar.json'), 'w') as f:
+        json.dump({"weekdays": {str(day): [] for day in range(7)}, "holidays": []}, f)
+
+    webhook_port = free_port()
+    env = dict(os.environ, BOT_TOKEN='123456:OFFLINE', BOT_API_BASE_URL=server.base_url,
+               BOT_MODE='webhook', WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(webhook_port),
+               WEBHOOK_PATH='/telegram', WEBHOOK_URL='', WEBHOOK_SECRET_TOKEN=SECRET,
+               METRICS_PORT='0', SHARD_COUNT='1')
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{webhook_port}/telegram'
+    try:
+        await wait_for(lambda: process.poll() is None and port_open(webhook_port))
+
+        update = {"update_id": 1, "message": {
+            "message_id": 10, "date": 0,
+            "chat": {"id": CLIENT_ID, "type": "private", "first_name": "Client"},
+            "from": {"id": CLIENT_ID, "is_bot": False, "first_name": "Client"},
+            "text": "Здравствуйте",
+        }}
+        body = json.dumps(update).encode('utf-8')
+
+        assert await asyncio.to_thread(post, url, body, 'wrong') == 403
+        assert await asyncio.to_thread(post, url, b'not json') == 400
+        assert await asyncio.to_thread(post, url, body) == 200
+
+        await wait_for(lambda: any(sent["chat_id"] == CLIENT_ID for sent in api.sent))
+        replies = [sent for sent in api.sent if sent["method"] == "sendMessage" and sent["chat_id"] == CLIENT_ID]
+        assert len(replies) == 1
+        assert api.calls['getMe'] == 1
+    finally:
+        process.terminate()
+        await asyncio.to_thread(process.wait, 10)
+        await server.stop()
+
+
+def test_webhook_auto_reply_offline(tmp_path):
+    asyncio.run(run_scenario(str(tmp_path)))